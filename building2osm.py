@@ -8,20 +8,28 @@
 
 
 import sys
+import os
 import time
-import copy
 import math
-import statistics
 import csv
+from collections import Counter, deque
 import json
+import hashlib
 import urllib.request
 import zipfile
 import subprocess
+import tempfile
+import shutil
+import concurrent.futures
 from io import TextIOWrapper
-from io import BytesIO
 from xml.etree import ElementTree as ET
 import utm  # From building2osm on GitHub
 
+try:
+	import orjson  # Faster json output, if available
+except ImportError:
+	orjson = None
+
 
 version = "0.7.0"
 
@@ -50,6 +58,9 @@ addr_margin = 100			# Max margin for matching address point with building centre
 
 max_download = 10000		# Max features permitted for downloading by WFS per query
 
+cache_folder = ".geonorge_cache"	# Folder for cached GeoNorge municipality lookups
+cache_age = 24 * 3600		# Max age of cached lookups (seconds)
+
 
 status_codes = {
 	'RA': 'Rammetillatelse',
@@ -64,6 +75,9 @@ status_codes = {
 	'FS': 'Fritatt for søknadsplikt'
 }
 
+feature_keys = frozenset(['type', 'geometry', 'properties'])  # Keys of building dict kept in output
+upper_case_tags = frozenset(['TYPE', 'STATUS', 'DATE'])  # Upper case tags kept in output when not debugging
+
 
 # Output message to console
 
@@ -111,6 +125,18 @@ def distance (point1, point2):
 
 
 
+# Compute squared distance between two coordinates, in radians.
+# For comparing distances only; distance() is 6371000 * sqrt of this value.
+
+def distance_squared (point1, point2):
+
+	lon1, lat1, lon2, lat2 = map(math.radians, [point1[0], point1[1], point2[0], point2[1]])
+	x = (lon2 - lon1) * math.cos( 0.5*(lat2+lat1) )
+	y = lat2 - lat1
+	return x*x + y*y
+
+
+
 # Calculate coordinate area of polygon in square meters
 # Simple conversion to planar projection, works for small areas
 # < 0: Clockwise
@@ -122,15 +148,15 @@ def polygon_area (polygon):
 	if polygon[0] == polygon[-1]:
 		lat_dist = math.pi * 6371000.0 / 180.0
 
-		coord = []
-		for node in polygon:
-			y = node[1] * lat_dist
-			x = node[0] * lat_dist * math.cos(math.radians(node[1]))
-			coord.append((x,y))
-
+		# Single pass, carrying projected coordinates of previous node. First term is zero.
 		area = 0.0
-		for i in range(len(coord) - 1):
-			area += (coord[i+1][0] - coord[i][0]) * (coord[i+1][1] + coord[i][1])  # (x2-x1)(y2+y1)
+		x1 = polygon[0][0] * lat_dist * math.cos(math.radians(polygon[0][1]))
+		y1 = polygon[0][1] * lat_dist
+		for lon, lat in polygon:
+			x2 = lon * lat_dist * math.cos(math.radians(lat))
+			y2 = lat * lat_dist
+			area += (x2 - x1) * (y2 + y1)  # (x2-x1)(y2+y1)
+			x1, y1 = x2, y2
 
 		return int(area / 2.0)
 	else:
@@ -168,6 +194,53 @@ def bearing (point1, point2):
 
 
 
+# Return longitudes and latitudes of polygon in radians, as two lists.
+# May be passed to polygon_bearings() and polygon_distances() to convert each node only once.
+
+def polygon_radians (polygon):
+
+	lon = [ math.radians(node[0]) for node in polygon ]
+	lat = [ math.radians(node[1]) for node in polygon ]
+	return (lon, lat)
+
+
+
+# Return list of bearings of all segments along polygon, i.e. bearing from node i to node i+1.
+# Same result as bearing(), but sine/cosine of each latitude is only computed once.
+
+def polygon_bearings (polygon, radians=None):
+
+	lon, lat = radians or polygon_radians(polygon)
+	sin_lat = [ math.sin(node_lat) for node_lat in lat ]
+	cos_lat = [ math.cos(node_lat) for node_lat in lat ]
+
+	bearings = []
+	for i in range(len(polygon) - 1):
+		dLon = lon[i+1] - lon[i]
+		y = math.sin(dLon) * cos_lat[i+1]
+		x = cos_lat[i] * sin_lat[i+1] - sin_lat[i] * cos_lat[i+1] * math.cos(dLon)
+		bearings.append( (math.degrees(math.atan2(y, x)) + 360) % 360 )
+
+	return bearings
+
+
+
+# Return list of lengths of all segments along polygon, i.e. distance from node i to node i+1.
+
+def polygon_distances (polygon, radians=None):
+
+	lon, lat = radians or polygon_radians(polygon)
+
+	distances = []
+	for i in range(len(polygon) - 1):
+		x = (lon[i+1] - lon[i]) * math.cos( 0.5*(lat[i+1]+lat[i]) )
+		y = lat[i+1] - lat[i]
+		distances.append( 6371000.0 * math.sqrt( x*x + y*y ) )
+
+	return distances
+
+
+
 # Return the difference between two bearings.
 # Negative degrees to the left, positive to the right.
 
@@ -182,15 +255,33 @@ def bearing_difference (bearing1, bearing2):
 
 
 
-# Return the shift in bearing at a junction.
-# Negative degrees to the left, positive to the right. 
+# Return list of turns at each node of polygon, given the segment bearings from polygon_bearings().
+# Turn at node i is the bearing difference from segment i-1 to segment i, wrapping around for the first node.
+
+def polygon_turns (bearings):
+
+	return [ bearing_difference(bearings[i-1], bearings[i]) for i in range(len(bearings)) ]
 
-def bearing_turn (point1, point2, point3):
 
-	bearing1 = bearing(point1, point2)
-	bearing2 = bearing(point2, point3)
 
-	return bearing_difference(bearing1, bearing2)
+# Return mean of list of floats, i.e. same as statistics.mean.
+# The sum is exact in integer arithmetic, and the final division is correctly rounded.
+
+def mean (values):
+
+	ratios = [ value.as_integer_ratio() for value in values ]
+	denominator = max(ratio[1] for ratio in ratios)  # Powers of two, so all divide the largest one
+	total = sum(numerator * (denominator // ratio_denominator) for numerator, ratio_denominator in ratios)
+
+	return total / (denominator * len(values))
+
+
+
+# Return low median of list of values, i.e. same as statistics.median_low
+
+def median_low (values):
+
+	return sorted(values)[ (len(values) - 1) // 2 ]
 
 
 
@@ -199,18 +290,32 @@ def bearing_turn (point1, point2, point3):
 
 def rotate_node (axis, r_angle, point):
 
-	r_radians = math.radians(r_angle)  # *(math.pi/180)
+	return rotate_nodes(axis, r_angle, [ point ])[0]
+
+
+
+# Rotate list of points with specified angle around axis point.
+# Trigonometric functions are only computed once for the whole list.
 
-	tr_y = point[1] - axis[1]
-	tr_x = (point[0] - axis[0]) * math.cos(math.radians(axis[1]))
+def rotate_nodes (axis, r_angle, points):
 
-	xrot = tr_x * math.cos(r_radians) - tr_y * math.sin(r_radians)  
-	yrot = tr_x * math.sin(r_radians) + tr_y * math.cos(r_radians)
+	r_radians = math.radians(r_angle)
+	cos_r = math.cos(r_radians)
+	sin_r = math.sin(r_radians)
+	axis_x, axis_y = axis
+	cos_lat = math.cos(math.radians(axis_y))
 
-	xnew = xrot / math.cos(math.radians(axis[1])) + axis[0]
-	ynew = yrot + axis[1]
+	new_points = []
+	for point_x, point_y in points:
+		tr_y = point_y - axis_y
+		tr_x = (point_x - axis_x) * cos_lat
 
-	return (xnew, ynew)
+		xrot = tr_x * cos_r - tr_y * sin_r
+		yrot = tr_x * sin_r + tr_y * cos_r
+
+		new_points.append((xrot / cos_lat + axis_x, yrot + axis_y))
+
+	return new_points
 
 
 
@@ -270,23 +375,60 @@ def line_distance(s1, s2, p3):
 
 # Simplify polygon, i.e. reduce nodes within epsilon distance.
 # Ramer-Douglas-Peucker method: https://en.wikipedia.org/wiki/Ramer–Douglas–Peucker_algorithm
+# Iterative version with a stack of segments. Nodes are reprojected once, same projection as in line_distance().
 
 def simplify_polygon(polygon, epsilon):
 
-	dmax = 0.0
-	index = 0
-	for i in range(1, len(polygon) - 1):
-		d = line_distance(polygon[0], polygon[-1], polygon[i])
-		if d > dmax:
-			index = i
-			dmax = d
+	projected = []
+	for node in polygon:
+		x, y = math.radians(node[0]), math.radians(node[1])
+		projected.append((x * math.cos(y), y))
+
+	keep = [False] * len(polygon)
+	keep[0] = True
+	keep[-1] = True
+	segments = [ (0, len(polygon) - 1) ]
+
+	while segments:
+		start, end = segments.pop()
+		x1, y1 = projected[start]
+		x2, y2 = projected[end]
+		dx = x2 - x1
+		dy = y2 - y1
+		len_sq = dx*dx + dy*dy
+
+		dmax = 0.0  # Squared distance in radians, converted to meters once per segment
+		index = 0
+		for i in range(start + 1, end):
+			x3, y3 = projected[i]
+
+			# Closest distance from node to segment, as in line_distance()
+			if len_sq != 0:
+				param = ((x3 - x1)*dx + (y3 - y1)*dy) / len_sq
+			else:
+				param = -1
+
+			if param < 0:
+				x4, y4 = x1, y1
+			elif param > 1:
+				x4, y4 = x2, y2
+			else:
+				x4 = x1 + param * dx
+				y4 = y1 + param * dy
 
-	if dmax >= epsilon:
-		new_polygon = simplify_polygon(polygon[:index+1], epsilon)[:-1] + simplify_polygon(polygon[index:], epsilon)
-	else:
-		new_polygon = [polygon[0], polygon[-1]]
+			x = x4 - x3
+			y = y4 - y3
+			d = x*x + y*y
+			if d > dmax:
+				index = i
+				dmax = d
 
-	return new_polygon
+		if 6371000 * math.sqrt(dmax) >= epsilon:
+			keep[index] = True
+			segments.append((index, end))
+			segments.append((start, index))
+
+	return [ node for node, keep_node in zip(polygon, keep) if keep_node ]
 
 
 
@@ -295,14 +437,11 @@ def simplify_polygon(polygon, epsilon):
 
 def parse_polygon(coord_text):
 
-	split_coord = coord_text.split(" ")
+	values = map(float, coord_text.split())
 	coordinates = []
 	last_node1 = (None, None)
 	last_node2 = (None, None)
-	for i in range(0, len(split_coord) - 1, 2):
-		lon = float(split_coord[i])
-		lat = float(split_coord[i+1])
-		node = (lon, lat)
+	for node in zip(values, values):  # Pairs of (lon, lat) from the same iterator
 		if node != last_node1:
 			if node == last_node2:
 				coordinates.pop()
@@ -316,11 +455,54 @@ def parse_polygon(coord_text):
 
 
 
+# Load json from url.
+# Cached on disk, since GeoNorge municipality lookups rarely change.
+
+def load_json_url (url):
+
+	filename = os.path.join(cache_folder, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+	if os.path.isfile(filename) and time.time() - os.path.getmtime(filename) < cache_age:
+		with open(filename, encoding="utf-8") as file:
+			return json.load(file)
+
+	file = urllib.request.urlopen(url)
+	data = json.load(file)
+	file.close()
+
+	# Write to temporary file first, so that an interrupted run does not leave a truncated cache file
+	os.makedirs(cache_folder, exist_ok=True)
+	temp_filename = filename + ".tmp"
+	with open(temp_filename, "w", encoding="utf-8") as file:
+		json.dump(data, file, ensure_ascii=False)
+	os.replace(temp_filename, filename)
+
+	return data
+
+
+
+# Download zip file from url.
+# Copied to a temporary file on disk instead of holding the whole download in memory.
+# A plain temporary file is used, since zipfile cannot seek in SpooledTemporaryFile before Python 3.11.
+
+def open_zip_url (url):
+
+	in_file = urllib.request.urlopen(url)
+	temp_file = tempfile.TemporaryFile()
+	shutil.copyfileobj(in_file, temp_file)
+	in_file.close()
+	temp_file.seek(0)
+
+	return zipfile.ZipFile(temp_file)
+
+
+
 # Transform url characters
 
+url_characters = str.maketrans("ÆØÅæøå ", "EOAeoa_")
+
 def fix_url (url):
 
-	return url.replace("Æ","E").replace("Ø","O").replace("Å","A").replace("æ","e").replace("ø","o").replace("å","a").replace(" ", "_")
+	return url.translate(url_characters)
 
 
 
@@ -334,14 +516,19 @@ def load_building_types():
 	building_csv = csv.DictReader(TextIOWrapper(file, "utf-8"), fieldnames=["id", "name", "osm_tag"], delimiter=";")
 	next(building_csv)
 
+	tag_sets = {}  # Building types with the same tags share one (read only) tags dict
+
 	for row in building_csv:
-		osm_tag = { 'building': 'yes' }
+		osm_tag = tag_sets.get(row['osm_tag'])
 
-		if row['osm_tag']:
-			tag_list = row['osm_tag'].replace(" ","").split("+")
-			for tag_part in tag_list:
-				tag_split = tag_part.split("=")
-				osm_tag[ tag_split[0] ] = tag_split[1]
+		if osm_tag is None:
+			osm_tag = { 'building': 'yes' }
+			if row['osm_tag']:
+				tag_list = row['osm_tag'].replace(" ","").split("+")
+				for tag_part in tag_list:
+					tag_split = tag_part.split("=")
+					osm_tag[ tag_split[0] ] = tag_split[1]
+			tag_sets[ row['osm_tag'] ] = osm_tag
 
 		building_types[ row['id'] ] = {
 			'name': row['name'],
@@ -364,7 +551,7 @@ def get_municipality (parameter):
 		parameter = parameter
 		found_id = ""
 		duplicate = False
-		for mun_id, mun_name in iter(municipalities.items()):
+		for mun_id, mun_name in municipalities.items():
 			if parameter.lower() == mun_name.lower():
 				return mun_id
 			elif parameter.lower() in mun_name.lower():
@@ -385,9 +572,7 @@ def get_municipality (parameter):
 def load_municipalities():
 
 	url = "https://ws.geonorge.no/kommuneinfo/v1/fylkerkommuner?filtrer=fylkesnummer%2Cfylkesnavn%2Ckommuner.kommunenummer%2Ckommuner.kommunenavnNorsk"
-	file = urllib.request.urlopen(url)
-	data = json.load(file)
-	file.close()
+	data = load_json_url(url)
 	for county in data:
 		if county['fylkesnavn'] == "Oslo":
 			county['fylkesnavn'] = "Oslo fylke"
@@ -401,9 +586,10 @@ def load_municipalities():
 
 # Load building polygons from WFS within given BBOX.
 # Note: Max 10.000 buildings will be returned from WFS. No paging provided.
-# Data parsed as text lines for performance reasons (very simple data structure)
+# Data stream parsed while downloading. Tags are resolved from the namespace prefixes declared in the response.
+# Runs in worker threads, so polygons are returned rather than stored in buildings.
 
-def load_building_coordinates(municipality_id, min_bbox, max_bbox, level):
+def load_building_coordinates(min_bbox, max_bbox):
 
 	bbox_list = [str(min_bbox[1]), str(min_bbox[0]), str(max_bbox[1]), str(max_bbox[0])]
 
@@ -411,108 +597,153 @@ def load_building_coordinates(municipality_id, min_bbox, max_bbox, level):
 			"service=WFS&version=2.0.0&request=GetFeature&srsName=EPSG:4326&typename=Building&bbox=" + ",".join(bbox_list)
 #	message ("\n\tQuery: %s\n\t" % url)
 	file_in = urllib.request.urlopen(url)
-	file = TextIOWrapper(file_in, "utf-8")
 
+	polygons = []
 	count_feature = 0
 	count_hits = 0
-	hit = False
+	ref = None
+	coordinates = []
+	namespaces = {}
+	reference_tag = pos_list_tag = member_tag = None
+	root = None
+
+	for event, elem in ET.iterparse(file_in, events=("start-ns", "start", "end")):
 
-	for line in file:
+		if event == "start-ns":
+			prefix, uri = elem
+			namespaces[ prefix ] = uri
+			reference_tag = "{%s}reference" % namespaces.get("bu-base")
+			pos_list_tag = "{%s}posList" % namespaces.get("gml")
+			member_tag = "{%s}member" % namespaces.get("wfs")
 
-		ref_index = line.find("<bu-base:reference>")
-		if ref_index > 0:
-			ref_end = line.find("<", ref_index + 19 )
-			ref = line[ ref_index + 19 : ref_end ]
+		elif event == "start":
+			if root is None:
+				root = elem  # Keep root, to detach parsed members from it
 
+		elif elem.tag == reference_tag:
+			ref = elem.text
 			coordinates = []
 			count_feature += 1
-
 			if ref in buildings:
-				hit = True
 				count_hits += 1
-			else:
-				hit = False
 
-		ref_index = line.find("<gml:posList>")
-		if ref_index > 0:
-			ref_end = line.find("<", ref_index + 13 )
-			geo = line[ ref_index + 13 : ref_end ]
-			coordinates.append( parse_polygon(geo) )
+		elif elem.tag == pos_list_tag:
+			polygon = [ shared_nodes.setdefault(node, node) for node in parse_polygon(elem.text) ]
+			coordinates.append(polygon)
 
-		if "</wfs:member>" in line:
+		elif elem.tag == member_tag:
 			if ref in buildings and coordinates:
+				polygons.append((ref, coordinates))
+			root.clear()  # Detach parsed members from root, to free memory
+
+	file_in.close()
+
+	return polygons, count_hits, count_feature
+
+
+
+# Load building polygons for list of BBOXes, each given as (min_bbox, max_bbox, level).
+# Downloads run concurrently, while polygons are stored in BBOX order as each download is done.
+# Boxes with too many buildings are split and reloaded when all the given boxes are done.
+
+def load_boxes(boxes):
+
+	count_load = 0
+	reload_boxes = []  # Split boxes to reload after this pool is done, to keep max 4 concurrent requests
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+		results = pool.map(lambda box: load_building_coordinates(box[0], box[1]), boxes)
+
+		for (min_bbox, max_bbox, level), (polygons, count_hits, count_feature) in zip(boxes, results):
+
+			count_load += 1
+			for ref, coordinates in polygons:
 				buildings[ref]['geometry']['type'] = "Polygon"
 				buildings[ref]['geometry']['coordinates'] = coordinates
 #				buildings[ref]['centre'] = polygon_centre(coordinates[0])
 
-	file_in.close()
+			if verbose:
+				message ("%sFound %i, loaded %i buildings\n" % ("\t" * level, count_hits, count_feature))
 
-	if verbose:
-		message ("Found %i, loaded %i buildings\n" % (count_hits, count_feature))
+			# If returned number of buildings is close to max WFS limit, then reload using smaller BBOX
 
-	# If returned number of buildings is close to max WFS limit, then reload using smaller BBOX
+			if count_feature > max_download - 10:
+				if verbose:
+					message ("%s*** Too many buildings in box, force split box and reloading\n" % ("\t" * level))
+				reload_boxes.extend(split_area(min_bbox, max_bbox, level, force_divide=True))
+			elif not verbose:
+				count_total_loaded = sum((building['geometry']['type'] == "Polygon") for building in buildings.values())
+				message ("\r\tLoading ... %6i " % count_total_loaded)
+
+	if reload_boxes:
+		count_load += load_boxes(reload_boxes)
 
-	count_load = 1
-	if count_feature > max_download - 10:
-		if verbose:
-			message ("%s*** Too many buildings in box, force split box and reloading" % ("\t" * level))
-		count_load += load_area(municipality_id, min_bbox, max_bbox, level, force_divide=True)
-	elif not verbose:
-		count_total_loaded = sum((building['geometry']['type'] == "Polygon") for building in buildings.values())
-		message ("\r\tLoading ... %6i " % count_total_loaded)
-		
 	return count_load
 
 
 
-# Recursively split municipality BBOX into smaller quadrants if needed to fit within WFS limit.
+# Split list of centres into those below and above given value for x (axis 0) or y (axis 1)
 
-def load_area(municipality_id, min_bbox, max_bbox, level, force_divide):
+def partition_centres(centres, axis, split_value):
 
-	# How many buildings from municipality within bbox?
-	count_load = 0
-	inside_box = 0
-	for building in buildings.values():
-		if min_bbox[0] <= building['centre'][0] <  max_bbox[0] and \
-			min_bbox[1] <= building['centre'][1] <  max_bbox[1]:
-			inside_box += 1
+	lower = []
+	upper = []
+	for centre in centres:
+		if centre[axis] < split_value:
+			lower.append(centre)
+		else:
+			upper.append(centre)
+
+	return lower, upper
 
-	# How many buildings from neighbour municipalities within bbox?
-	neighbour_inside_box = 0
-	for building_node in neighbour_buildings:
-		if min_bbox[0] <= building_node[0] <  max_bbox[0] and \
-			min_bbox[1] <= building_node[1] <  max_bbox[1]:
-			neighbour_inside_box += 1
+
+
+# Recursively split municipality BBOX into smaller quadrants if needed to fit within WFS limit.
+# Returns list of BBOXes to load, as (min_bbox, max_bbox, level).
+# Building centres and neighbour centres within the BBOX are partitioned when splitting,
+# so that each quadrant receives only its own centres.
+
+def split_area(min_bbox, max_bbox, level, force_divide, centres=None, neighbour_centres=None):
+
+	# How many buildings from municipality and from neighbour municipalities within bbox?
+	# When splitting, centres are already partitioned for each half and need no further filtering.
+	if centres is None:
+		centres = [ building['centre'] for building in buildings.values() \
+						if min_bbox[0] <= building['centre'][0] <  max_bbox[0] and min_bbox[1] <= building['centre'][1] <  max_bbox[1] ]
+		neighbour_centres = [ centre for centre in neighbour_buildings \
+								if min_bbox[0] <= centre[0] <  max_bbox[0] and min_bbox[1] <= centre[1] <  max_bbox[1] ]
+	inside_box = len(centres)
+	neighbour_inside_box = len(neighbour_centres)
 
 	if verbose and not force_divide:
-		message("%sExpecting %i buildings + %i neighbours ... " % ("\t" * level, inside_box, neighbour_inside_box))
+		message("%sExpecting %i buildings + %i neighbours\n" % ("\t" * level, inside_box, neighbour_inside_box))
 
 	if inside_box == 0:
-		if verbose:
-			message ("\n")
-		return count_load
+		return []
 
-	# Do actual loading of data
+	# Load box as it is
 	elif inside_box + neighbour_inside_box < 0.95 * max_download and not force_divide:
-		count_load += load_building_coordinates(municipality_id, min_bbox, max_bbox, level)
+		return [ (min_bbox, max_bbox, level) ]
 
 	else:
 		# Split bbox to get fewer than 10.000 buildings within bbox
 		if verbose:
-			message ("\n%sSplit box\n" % ("\t" * level))
+			message ("%sSplit box\n" % ("\t" * level))
 
 		if distance((min_bbox[0], max_bbox[1]), max_bbox) > distance(min_bbox, (min_bbox[0], max_bbox[1])):  # x longer than y
 			# Split x axis
 			half_x = 0.5 * (max_bbox[0] + min_bbox[0])
-			count_load += load_area(municipality_id, min_bbox, (half_x, max_bbox[1]), level + 1, force_divide=False)
-			count_load += load_area(municipality_id, (half_x, min_bbox[1]), max_bbox, level + 1, force_divide=False)
+			lower_centres, upper_centres = partition_centres(centres, 0, half_x)
+			lower_neighbours, upper_neighbours = partition_centres(neighbour_centres, 0, half_x)
+			return split_area(min_bbox, (half_x, max_bbox[1]), level + 1, force_divide=False, centres=lower_centres, neighbour_centres=lower_neighbours) + \
+					split_area((half_x, min_bbox[1]), max_bbox, level + 1, force_divide=False, centres=upper_centres, neighbour_centres=upper_neighbours)
 		else:
 			# Split y axis
 			half_y = 0.5 * (max_bbox[1] + min_bbox[1])
-			count_load += load_area(municipality_id, min_bbox, (max_bbox[0], half_y), level + 1, force_divide=False)
-			count_load += load_area(municipality_id, (min_bbox[0], half_y), max_bbox, level + 1, force_divide=False)
-
-	return count_load
+			lower_centres, upper_centres = partition_centres(centres, 1, half_y)
+			lower_neighbours, upper_neighbours = partition_centres(neighbour_centres, 1, half_y)
+			return split_area(min_bbox, (max_bbox[0], half_y), level + 1, force_divide=False, centres=lower_centres, neighbour_centres=lower_neighbours) + \
+					split_area((min_bbox[0], half_y), max_bbox, level + 1, force_divide=False, centres=upper_centres, neighbour_centres=upper_neighbours)
 
 
 
@@ -525,20 +756,23 @@ def load_coordinates_municipality(municipality_id):
 
 
 	if municipality_id != "2100":
-		file = urllib.request.urlopen("https://ws.geonorge.no/kommuneinfo/v1/kommuner/" + municipality_id)
-		data = json.load(file)
-		file.close()
+		data = load_json_url("https://ws.geonorge.no/kommuneinfo/v1/kommuner/" + municipality_id)
 		bbox = data['avgrensningsboks']['coordinates'][0]
 	else:
 		bbox = [[9.0, 74.0], [], [35.0, 81.0], []]  # Svalbard
 
-	count_load = load_area(municipality_id, bbox[0], bbox[2], 1, force_divide=False)  # Start with full bbox
+	boxes = split_area(bbox[0], bbox[2], 1, force_divide=False)  # Start with full bbox
+	count_load = load_boxes(boxes)
 
 	# Adjust building tagging according to size
 
+	count_polygons = 0
 	for building in buildings.values():
-		if building['geometry']['type'] == "Polygon" and "building" in building['properties'] and \
-				building['properties']['building'] in ["garage", "barn", "hotel"]:
+		if building['geometry']['type'] != "Polygon":
+			continue
+		count_polygons += 1
+
+		if "building" in building['properties'] and building['properties']['building'] in ["garage", "barn", "hotel"]:
 
 			area = abs(polygon_area(building['geometry']['coordinates'][0]))
 			if building['properties']['building'] == "garage" and area > 100:
@@ -553,16 +787,29 @@ def load_coordinates_municipality(municipality_id):
 			elif building['properties']['building'] == "hotel" and area < 100:
 				building['properties']['building'] = "cabin"
 
-	count_polygons = sum((building['geometry']['type'] == "Polygon") for building in buildings.values())
 	message ("\r\tLoaded %i building polygons with %i load queries\n" % (count_polygons, count_load))
 
 
 
+# Download zip file with building info for municipality from cadastral registry.
+
+def load_building_file(municipality_id, municipality_name):
+
+	url = "https://nedlasting.geonorge.no/geonorge/Basisdata/MatrikkelenBygning/GML/Basisdata_%s_%s_25833_MatrikkelenBygning_GML.zip" \
+			% (municipality_id, municipality_name)
+	url = fix_url(url)
+#	message ("\tFile: %s\n" % url)
+
+	return open_zip_url(url)
+
+
+
 # Get info about buildings from cadastral registry.
 # To aid data fetching of building polygons from WFS + to be merged with polygons later.
 # Function can also load building info from neighbour municipalities, to aid bbox splitting when loading building polygons.
+# Zip file is downloaded unless already provided.
 
-def load_building_info(municipality_id, municipality_name, neighbour):
+def load_building_info(municipality_id, municipality_name, neighbour, zip_file=None):
 
 	global max_download
 
@@ -576,18 +823,27 @@ def load_building_info(municipality_id, municipality_name, neighbour):
 			'app': ns_app
 	}
 
-	# Load file from GeoNorge
+	# Qualified tags, to pick child elements of each building in one pass
 
-	url = "https://nedlasting.geonorge.no/geonorge/Basisdata/MatrikkelenBygning/GML/Basisdata_%s_%s_25833_MatrikkelenBygning_GML.zip" \
-			% (municipality_id, municipality_name)
-	url = fix_url(url)
+	tag_building = '{%s}Bygning' % ns_app
+	tag_ref = '{%s}bygningsnummer' % ns_app
+	tag_position = '{%s}representasjonspunkt' % ns_app
+	tag_pos = '{%s}pos' % ns_gml
+	tag_type = '{%s}bygningstype' % ns_app
+	tag_status = '{%s}bygningsstatus' % ns_app
+	tag_date = '{%s}oppdateringsdato' % ns_app
+	tag_heritage = '{%s}harKulturminne' % ns_app
+	tag_sefrak = '{%s}sefrakIdent' % ns_app
+	tag_dwelling = '{%s}bruksenhet' % ns_app
+	tag_dwelling_id = '{%s}bruksenhetId' % ns_app
+
+	# Load file from GeoNorge
 
 	if not neighbour:
 		message ("Loading building information from cadastral registry ...\n")
-#		message ("\tFile: %s\n" % url)
 
-	in_file = urllib.request.urlopen(url)
-	zip_file = zipfile.ZipFile(BytesIO(in_file.read()))
+	if zip_file is None:
+		zip_file = load_building_file(municipality_id, municipality_name)
 
 	# If building file is being updated at server, it will not be available
 	if len(zip_file.namelist()) == 0:
@@ -601,20 +857,34 @@ def load_building_info(municipality_id, municipality_name, neighbour):
 	filename = zip_file.namelist()[0]
 	file = zip_file.open(filename)
 
-	tree = ET.parse(file)
-	file.close()
-	root = tree.getroot()
+	# Parse features one by one while reading the file, without building the full tree
+
+	context = ET.iterparse(file, events=("start", "end"))
+	event, root = next(context)
+	member_tag = '{%s}featureMember' % ns_gml
 	count = 0
 
 	not_found = []
 
-	for feature in root.iter('{%s}featureMember' % ns_gml):
+	for event, feature in context:
 
-		count += 1
-		building = feature.find('app:Bygning', ns)
-		ref = building.find('app:bygningsnummer', ns).text
+		if event != "end" or feature.tag != member_tag:
+			continue
 
-		position = building.find("app:representasjonspunkt/gml:Point/gml:pos", ns).text
+		root.clear()  # Detach parsed features from root. Current feature is kept until done.
+		count += 1
+		building = feature.find(tag_building)
+		children = {}
+		dwelling_elements = []
+		for child in building:
+			if child.tag == tag_dwelling:
+				dwelling_elements.append(child)
+			elif child.tag not in children:
+				children[ child.tag ] = child
+
+		ref = children[ tag_ref ].text
+
+		position = next(children[ tag_position ].iter(tag_pos)).text
 		position_split = position.split()
 		x, y = float(position_split[0]), float(position_split[1])
 		[lat, lon] = utm.UtmToLatLon (x, y, 33, "N")  # Reproject from UTM to WGS84
@@ -624,8 +894,8 @@ def load_building_info(municipality_id, municipality_name, neighbour):
 			neighbour_buildings.append(centre)  # We only need centre coordinates for neighbour municipalities
 			continue
 
-		building_type = building.find("app:bygningstype", ns).text
-		building_status = building.find("app:bygningsstatus", ns).text
+		building_type = children[ tag_type ].text
+		building_status = children[ tag_status ].text
 
 		feature = {
 			"type": "Feature",
@@ -648,15 +918,17 @@ def load_building_info(municipality_id, municipality_name, neighbour):
 		elif building_type not in not_found:
 			not_found.append(building_type)
 
-		source_date = building.find("app:oppdateringsdato", ns)
+		source_date = children.get(tag_date)
 		if source_date is not None:
 			feature['properties']['DATE'] = source_date.text[:10]
 
-		heritage = building.find("app:harKulturminne", ns).text
+		heritage = children[ tag_heritage ].text
 		if heritage == "true":
 			feature['properties']['heritage'] = "yes"
 
-		sefrak = building.find("app:sefrakIdent/app:SefrakIdent", ns)
+		sefrak = children.get(tag_sefrak)
+		if sefrak is not None:
+			sefrak = sefrak.find("app:SefrakIdent", ns)
 		if sefrak is not None:
 			sefrak = "%s-%s-%s" % (sefrak.find("app:sefrakKommune", ns).text,
 									sefrak.find("app:registreringskretsnummer", ns).text,
@@ -665,8 +937,8 @@ def load_building_info(municipality_id, municipality_name, neighbour):
 
 		# Establish link to all "bruksenhet" associated with building, for later updating building levels
 
-		for dwelling in building.findall("app:bruksenhet", ns):
-			dwelling_id = dwelling.find("app:Bruksenhet/app:bruksenhetId", ns)
+		for dwelling in dwelling_elements:
+			dwelling_id = next(dwelling.iter(tag_dwelling_id), None)
 			if dwelling_id is not None:
 				dwellings[ dwelling_id.text ] = feature
 
@@ -675,6 +947,8 @@ def load_building_info(municipality_id, municipality_name, neighbour):
 
 		buildings[ ref ] = feature
 
+	file.close()
+
 	if not neighbour:
 		message("\tLoaded %i buildings\n" % count)
 		if not_found:
@@ -692,14 +966,16 @@ def load_neighbour_buildings(municipality_id):
 		message ("Load building points for neighbour municipalities ...\n")
 
 		# Load neighbour municipalities
-		file = urllib.request.urlopen("https://ws.geonorge.no/kommuneinfo/v1/kommuner/" + municipality_id + "/nabokommuner")
-		data = json.load(file)
-		file.close()
+		data = load_json_url("https://ws.geonorge.no/kommuneinfo/v1/kommuner/" + municipality_id + "/nabokommuner")
+
+		# Download concurrently, while parsing files in order as they arrive
+		with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+			zip_files = pool.map(lambda municipality: load_building_file(municipality['kommunenummer'], municipality['kommunenavnNorsk']), data)
 
-		for municipality in data:
-			message ("\tLoading %s ... " % municipality['kommunenavnNorsk'])
-			count = load_building_info(municipality['kommunenummer'], municipality['kommunenavnNorsk'], neighbour=True)
-			message ("loaded %i buildings\n" % count)
+			for municipality, zip_file in zip(data, zip_files):
+				message ("\tLoading %s ... " % municipality['kommunenavnNorsk'])
+				count = load_building_info(municipality['kommunenummer'], municipality['kommunenavnNorsk'], neighbour=True, zip_file=zip_file)
+				message ("loaded %i buildings\n" % count)
 
 		message ("\tLoaded %i neighbour building points for reference\n" % len(neighbour_buildings))
 
@@ -719,19 +995,25 @@ def load_building_levels(municipality_id, municipality_name):
 	message ("Loading building level information from cadastral registry ...\n")
 #	message ("\tUrl: %s\n" % url)
 
-	in_file = urllib.request.urlopen(url)
-	zip_file = zipfile.ZipFile(BytesIO(in_file.read()))
+	zip_file = open_zip_url(url)
 
 	if len(zip_file.namelist()) < 2:
 		message ("\n\t*** No apartment data available (you may try again later)\n\n")
 		return
 
 	csv_file = zip_file.open(zip_file.namelist()[1])
-	addr_table = csv.DictReader(TextIOWrapper(csv_file, "utf-8"), delimiter=";")
+	addr_table = csv.reader(TextIOWrapper(csv_file, "utf-8"), delimiter=";")
+
+	# Plain rows, with columns found from header
+	header = next(addr_table)
+	column_dwelling = header.index("bruksenhetId")
+	column_level = header.index("bruksenhetsnummerTekst")
 
 	for row in addr_table:
-		if row['bruksenhetId'] in dwellings:
-			building = dwellings[ row['bruksenhetId'] ]
+		if not row:  # Skip blank lines, as DictReader would
+			continue
+		building = dwellings.get(row[ column_dwelling ])  # Buildings are matched by dwelling id, not by location
+		if building is not None:
 
 			if "levels" not in building:
 				building['levels'] = {
@@ -743,14 +1025,14 @@ def load_building_levels(municipality_id, municipality_name):
 
 			# Update highest level if available
 
-			if row['bruksenhetsnummerTekst']:
-				level_type = row['bruksenhetsnummerTekst'][0]
-				level_number = int(row['bruksenhetsnummerTekst'][1:3])
+			level_text = row[ column_level ]
+			if level_text:
+				level_type = level_text[0]
+				level_number = int(level_text[1:3])
 				building['levels'][ level_type ] = max(building['levels'][ level_type ], level_number)
 
 	csv_file.close()
 	zip_file.close()
-	in_file.close()
 	count = 0
 
 	for building in buildings.values():
@@ -777,27 +1059,25 @@ def simplify_buildings():
 	message ("Simplify polygons ...\n")
 	message ("\tSimplification factor: %.2f m (curve), %i degrees (line)\n" % (simplify_margin, angle_margin))
 
-	# Make dict of all nodes with count of usage
+	# Make dict of all nodes with count of usage.
+	# Buildings with polygons are collected once, to avoid testing geometry type in each pass.
 
-	count = 0
-	nodes = {}
-	for ref, building in iter(buildings.items()):
-		if building['geometry']['type'] == "Polygon":
-			for polygon in building['geometry']['coordinates']:
-				for node in polygon:
-					if node not in nodes:
-						nodes[ node ] = 1
-					else:
-						nodes[ node ] += 1
-						count += 1
+	polygon_buildings = [ building for building in buildings.values() if building['geometry']['type'] == "Polygon" ]
+
+	nodes = Counter()
+	for building in polygon_buildings:
+		for polygon in building['geometry']['coordinates']:
+			nodes.update(polygon)
+
+	count = sum(nodes.values()) - len(nodes)  # Repeated usage of nodes
 
 	message ("\t%i nodes used by more than one building\n" % count)
 
 	# Identify redundant nodes, i.e. nodes on an (almost) straight line
 
 	count = 0
-	for ref, building in iter(buildings.items()):
-		if building['geometry']['type'] == "Polygon" and ("rectified" not in building or building['rectified'] == "no"):
+	for building in polygon_buildings:
+		if "rectified" not in building or building['rectified'] == "no":
 
 			for polygon in building['geometry']['coordinates']:
 
@@ -806,9 +1086,12 @@ def simplify_buildings():
 				curves = set()
 				curve = set()
 				last_bearing = 0
+				radians = polygon_radians(polygon)
+				bearings = polygon_bearings(polygon, radians)
+				turns = polygon_turns(bearings)
 
 				for i in range(1, len(polygon) - 1):
-					new_bearing = bearing_turn(polygon[i-1], polygon[i], polygon[i+1])
+					new_bearing = turns[i]
 
 					if math.copysign(1, last_bearing) == math.copysign(1, new_bearing) and curve_margin_min < abs(new_bearing) < curve_margin_max:
 						curve.add(i - 1)
@@ -841,28 +1124,35 @@ def simplify_buildings():
 
 					if len(new_polygon) < len(polygon):
 						building['properties']['VERIFY_SIMPLIFY_CURVE'] = str(len(polygon) - len(new_polygon))
+						kept_nodes = set(new_polygon)
 						for node in polygon:
-							if node not in new_polygon:
+							if node not in kept_nodes:
 								nodes[ node ] -= 1
 				else:
 					# Simplification for buildings without curves
 
-					last_node = polygon[-2]
-					for i in range(len(polygon) - 1):
-						angle = bearing_turn(last_node, polygon[i], polygon[i+1])
-						length = distance(polygon[i], polygon[i+1])
+					# Reuse segment bearings and turns from curve test while previous node is kept
+					distances = polygon_distances(polygon, radians)
+					n = len(polygon) - 1
+					last = n - 1
+					for i in range(n):
+						if last == (i - 1) % n:
+							angle = turns[i]
+						else:
+							angle = bearing_difference(bearing(polygon[last], polygon[i]), bearings[i])
+						length = distances[i]
 
 						if (abs(angle) < angle_margin or \
 							length < short_margin and \
 								(abs(angle) < 40 or \
-								abs(angle + bearing_turn(polygon[i], polygon[i+1], polygon[(i+2) % (len(polygon)-1)])) < angle_margin) or \
+								abs(angle + turns[(i+1) % n]) < angle_margin) or \
 							length < corner_margin and abs(angle) < 2 * angle_margin):
 
 							nodes[ polygon[i] ] -= 1
 							if angle > angle_margin - 2:
 								building['properties']['VERIFY_SIMPLIFY_LINE'] = "%.1f" % abs(angle)
 						else:
-							last_node = polygon[i]
+							last = i
 					
 	if debug or verify:
 		message ("\tIdentified %i buildings with curved walls\n" % count)
@@ -878,20 +1168,19 @@ def simplify_buildings():
 
 	count_building = 0
 	count_remove = 0
-	for ref, building in iter(buildings.items()):
-		if building['geometry']['type'] == "Polygon":
-			removed = False
-			for polygon in building['geometry']['coordinates']:
-				for node in polygon[:-1]:
-					if node in remove_nodes:
-						i = polygon.index(node)
-						polygon.pop(i)
-						count_remove += 1
-						removed = True
-						if i == 0:
-							polygon[-1] = polygon[0]
-			if removed:
-				count_building += 1
+	for building in polygon_buildings:
+		removed = False
+		coordinates = building['geometry']['coordinates']
+		for i, polygon in enumerate(coordinates):
+			new_polygon = [ node for node in polygon[:-1] if node not in remove_nodes ]
+			if len(new_polygon) < len(polygon) - 1:
+				count_remove += len(polygon) - 1 - len(new_polygon)
+				removed = True
+				if new_polygon:
+					new_polygon.append(new_polygon[0])  # Close polygon again, also if first node was removed
+				coordinates[i] = new_polygon
+		if removed:
+			count_building += 1
 
 	message ("\tRemoved %i redundant nodes in %i buildings\n" % (count_remove, count_building))
 
@@ -930,30 +1219,29 @@ def rectify_buildings():
 
 	count = 0
 	nodes = {}
-	for ref, building in iter(buildings.items()):
+	for ref, building in buildings.items():
 		if building['geometry']['type'] == "Polygon":
 			for polygon in building['geometry']['coordinates']:
 				for node in polygon[:-1]:
-					if node not in nodes:
+					node_usage = nodes.get(node)
+					if node_usage is None:
 						nodes[ node ] = {
 							'use': 1,
-							'parents': [building]
+							'parents': { id(building): building }
 						}
 					else:
-						nodes[ node ]['use'] += 1
-						if building not in nodes[ node ]['parents']:
-							nodes[ node ]['parents'].append( building )
+						node_usage['use'] += 1
+						node_usage['parents'].setdefault(id(building), building)
 						count += 1
-			building['neighbours'] = [ building ]
+			building['neighbours'] = { id(building): building }
 
-	# Add list of neighbours to each building (other buildings which share one or more node)
+	# Add neighbours to each building (other buildings which share one or more node).
+	# Parents and neighbours are dicts keyed by id of building, to keep order and give fast lookup.
 
 	for node in nodes.values():
 		if node['use'] > 1:
-			for parent in node['parents']:
-				for neighbour in node['parents']:
-					if neighbour not in parent['neighbours']:
-						parent['neighbours'].append(neighbour)  # Including self
+			for parent in node['parents'].values():
+				parent['neighbours'].update(node['parents'])  # Including self
 
 	message ("\t%i nodes used by more than one building\n" % count)
 
@@ -963,25 +1251,30 @@ def rectify_buildings():
 	count_not_rectify = 0
 	count_remove = 0
 	count = 0
+	processed = set()  # Id of buildings already handled as part of a group
 
-	for ref, building_test in iter(buildings.items()):
+	for ref, building_test in buildings.items():
 
 		count += 1
 		message ("\r\t%i " % count)
 
-		if building_test['geometry']['type'] != "Polygon" or "rectified" in building_test:
+		if building_test['geometry']['type'] != "Polygon" or id(building_test) in processed:
 			continue
 
 		# 1. First identify buildings which are connected and must be rectified as a group
 
 		building_group = []
-		check_neighbours = building_test['neighbours']  # includes self
+		check_neighbours = deque(building_test['neighbours'].values())  # includes self
+		found = set(building_test['neighbours'])  # Buildings already in group or to be checked
 		while check_neighbours:
-			for neighbour in check_neighbours[0]['neighbours']:
-				if neighbour not in building_group and neighbour not in check_neighbours:
+			check_building = check_neighbours.popleft()
+			for neighbour_id, neighbour in check_building['neighbours'].items():
+				if neighbour_id not in found:
+					found.add(neighbour_id)
 					check_neighbours.append(neighbour)
-			building_group.append(check_neighbours[0])
-			check_neighbours.pop(0)
+			building_group.append(check_building)
+
+		processed.update(found)  # Whole group is settled below, either rectified or not
 
 		if len(building_group) > 1:
 			building_test['properties']['VERIFY_GROUP'] = str(len(building_group)) 
@@ -1012,27 +1305,41 @@ def rectify_buildings():
 				patch_walls = []
 				wall = { 'nodes': [] }
 				count_corners = 0
-				last_corner = polygon[-2]  # Wrap polygon for first test
+				n = len(polygon) - 1
+				last_corner = n - 1  # Wrap polygon for first test
+				radians = polygon_radians(polygon)
+				bearings = polygon_bearings(polygon, radians)
+				distances = polygon_distances(polygon, radians)
+				turns = polygon_turns(bearings)
+				use = [ nodes[ node ]['use'] for node in polygon[:-1] ]  # Number of ways using each node
 
-				for i in range(len(polygon) - 1):
+				for i in range(n):
 
 					last_count = count_corners
 
-					test_corner = bearing_turn(last_corner, polygon[i], polygon[i+1])
-					angles.append("%i" % test_corner)
-					short_length = min(distance(last_corner, polygon[i]), distance(polygon[i], polygon[i+1])) # Test short walls
+					# Segment from last corner is only precomputed if no nodes were skipped since then
+					if last_corner == (i - 1) % n:
+						test_corner = turns[i]
+						last_distance = distances[last_corner]
+					else:
+						test_corner = bearing_difference(bearing(polygon[last_corner], polygon[i]), bearings[i])
+						last_distance = distance(polygon[last_corner], polygon[i])
+
+					if debug:
+						angles.append("%i" % test_corner)
+					short_length = min(last_distance, distances[i]) # Test short walls
 
 					# Remove short wall if on (almost) straight line
-					if distance(polygon[i], polygon[i+1]) < short_margin and \
-							abs(test_corner + bearing_turn(polygon[i], polygon[i+1], polygon[(i+2) % (len(polygon)-1)])) < angle_margin and \
-							nodes[ polygon[i] ]['use'] == 1:
+					if distances[i] < short_margin and \
+							abs(test_corner + turns[(i+1) % n]) < angle_margin and \
+							use[i] == 1:
 
 						update_corner(corners, None, polygon[i], 0)
-						building['properties']['VERIFY_SHORT_REMOVE'] = "%.2f" % distance(polygon[i], polygon[i+1])
+						building['properties']['VERIFY_SHORT_REMOVE'] = "%.2f" % distances[i]
 
 					# Identify (almost) 90 degree corner and start new wall
 					elif 90 - angle_margin < abs(test_corner) < 90 + angle_margin or \
-							 short_length < corner_margin and 60 < abs(test_corner) < 120 and nodes[ polygon[i] ]['use'] == 1:
+							 short_length < corner_margin and 60 < abs(test_corner) < 120 and use[i] == 1:
 #							 45 - angle_margin < abs(test_corner) < 45 + angle_margin or \
 
 						update_corner(corners, wall, polygon[i], 1)
@@ -1043,29 +1350,30 @@ def rectify_buildings():
 
 						wall = { 'nodes': [] }  # Start new wall
 						update_corner(corners, wall, polygon[i], 1)
-						last_corner = polygon[i]
+						last_corner = i
 						count_corners += 1
 
 					# Not possible to rectify if wall is other than (almost) straight line
 					elif abs(test_corner) > angle_margin:
 						conform = False
 						building['properties']['DEBUG_NORECTIFY'] = "No, %i degree angle" % test_corner
-						last_corner = polygon[i]
+						last_corner = i
 
 					# Keep node if used by another building or patch
-					elif nodes[ polygon[i] ]['use'] > 1: 
+					elif use[i] > 1: 
 						update_corner(corners, wall, polygon[i], 0)
-						last_corner = polygon[i]
+						last_corner = i
 
 					# Else throw away node (redundant node on (almost) straight line)
 					else:
 						update_corner(corners, None, polygon[i], 0)  # Node on "straight" line, will not be used
 
 					# For debugging, mark cases where a slightly larger margin would have produced a rectified polygon
-					if count_corners != last_count and not conform and 90 - angle_margin + 2 < abs(test_corner) < 90 + angle_margin + 2:
+					if debug and count_corners != last_count and not conform and 90 - angle_margin + 2 < abs(test_corner) < 90 + angle_margin + 2:
 						building['properties']['DEBUG_MISSED_CORNER'] = str(int(abs(test_corner)))
 
-				building['properties']['DEBUG_ANGLES'] = " ".join(angles)
+				if debug:
+					building['properties']['DEBUG_ANGLES'] = " ".join(angles)
 
 				if count_corners % 2 == 1:  # Must be even number of corners
 					conform = False
@@ -1076,10 +1384,13 @@ def rectify_buildings():
 					# Wrap from end to start
 					patch_walls[0]['nodes'] = wall['nodes'] + patch_walls[0]['nodes']
 					for node in wall['nodes']:
-						wall_index = len(corners[node]['walls']) - corners[node]['walls'][::-1].index(wall) - 1  # Find last occurrence
-						corners[node]['walls'].pop(wall_index)  # remove(wall)
-						if patch_walls[0] not in corners[node]['walls']:
-							corners[node]['walls'].append(patch_walls[0])
+						node_walls = corners[node]['walls']
+						wall_index = len(node_walls) - 1
+						while node_walls[wall_index] is not wall:  # Find last occurrence, without reversed copy
+							wall_index -= 1
+						node_walls.pop(wall_index)  # remove(wall)
+						if patch_walls[0] not in node_walls:
+							node_walls.append(patch_walls[0])
 
 					walls.append(patch_walls)
 
@@ -1093,16 +1404,28 @@ def rectify_buildings():
 			continue
 
 		# 3. Remove unused nodes
-
-		for node in list(corners.keys()):
-			if corners[node]['used'] == 0:
-				for patch in walls:
-					for wall in patch:
-						if node in wall['nodes']:
-							wall['nodes'].remove(node)
+		# Each wall is only rebuilt if it contains unused nodes, dropping the first occurrence of each of them.
+		# Unused nodes are kept in a dict to give fast lookup while keeping order of corners.
+
+		unused_nodes = dict.fromkeys(node for node, corner in corners.items() if corner['used'] == 0)
+
+		if unused_nodes:
+			for patch in walls:
+				for wall in patch:
+					if not unused_nodes.keys().isdisjoint(wall['nodes']):
+						removed = set()
+						new_nodes = []
+						for node in wall['nodes']:
+							if node in unused_nodes and node not in removed:
+								removed.add(node)
+							else:
+								new_nodes.append(node)
+						wall['nodes'] = new_nodes
+
+			for node in unused_nodes:
 				remove_nodes.add(node)
 				del corners[node]
-				count_remove += 1
+			count_remove += len(unused_nodes)
 
 		# 4. Get average bearing of all ways
 
@@ -1141,7 +1464,7 @@ def rectify_buildings():
 				wall['bearing'] = wall_bearing
 				bearings.append(wall_bearing)
 
-			group_bearing = statistics.median_low(bearings)
+			group_bearing = median_low(bearings)
 
 		# Compute centre for rotation, average of all corner nodes in cluster of buildings
 		axis = polygon_centre(list(corners.keys()))
@@ -1153,11 +1476,12 @@ def rectify_buildings():
 				if 0 <= wall < 90:
 					bearings[i] = wall + 180  # Fix wrap-around problem at 180
 
-		avg_bearing = statistics.median_low(bearings)  # Use median to get dominant bearings
+		avg_bearing = median_low(bearings)  # Use median to get dominant bearings
 
-		building['properties']['DEBUG_BEARINGS'] = str([int(degree) for degree in bearings])
-		building['properties']['DEBUG_AXIS'] = str([wall['axis'] for patch in walls for wall in patch ])
-		building['properties']['DEBUG_BEARING'] = "%.1f" % avg_bearing
+		if debug:
+			building['properties']['DEBUG_BEARINGS'] = str([int(degree) for degree in bearings])
+			building['properties']['DEBUG_AXIS'] = str([wall['axis'] for patch in walls for wall in patch ])
+			building['properties']['DEBUG_BEARING'] = "%.1f" % avg_bearing
 
 		# 5. Combine connected walls with same axis
 		# After this section, the wall list in corners is no longer accurate
@@ -1166,38 +1490,54 @@ def rectify_buildings():
 
 		combine_walls = []  # List will contain all combinations of walls in group which can be combined
 
+		# Walls are compared by value, so that walls with equal nodes, axis and bearing are only combined once.
+		# Value keys are computed once per wall and kept in sets for fast lookup.
+
+		wall_keys = { id(wall): (tuple(wall['nodes']), wall['axis'], wall['bearing']) for wall in walls }
+		combined = set()  # Keys of walls already combined
+
 		for wall in walls:
-			if any(wall in w for w in combine_walls):  # Avoid walls which are already combined
+			if wall_keys[ id(wall) ] in combined:  # Avoid walls which are already combined
 				continue
 
 			# Identify connected walls with same axis
 			connected_walls = []
-			check_neighbours = [ wall ]  # includes self
+			check_neighbours = deque([ wall ])  # includes self
+			found = { wall_keys[ id(wall) ] }  # Walls already connected or to be checked
 			while check_neighbours:
-				if check_neighbours[0]['axis'] == wall['axis']:
-					for node in check_neighbours[0]['nodes']:
-						for check_wall in corners[ node ]['walls']:
-							if check_wall['axis'] == wall['axis'] and check_wall not in check_neighbours and check_wall not in connected_walls:
+				connected_wall = check_neighbours.popleft()
+				connected_walls.append(connected_wall)
+				for node in connected_wall['nodes']:
+					for check_wall in corners[ node ]['walls']:
+						if check_wall['axis'] == wall['axis']:
+							check_key = wall_keys[ id(check_wall) ]
+							if check_key not in found:
+								found.add(check_key)
 								check_neighbours.append(check_wall)
-					connected_walls.append(check_neighbours[0])
-					check_neighbours.pop(0)
 
 			if len(connected_walls) > 1:
 				combine_walls.append(connected_walls)
+				combined.update(found)
 
-		if combine_walls:
+		if debug and combine_walls:
 			building_test['properties']['DEBUG_COMBINE'] = str([len(l) for l in combine_walls])
 
 		# Combine nodes of connected walls into one remaining wall
 		for combination in combine_walls:
 			main_wall = combination[0]
+			main_nodes = dict.fromkeys(main_wall['nodes'])  # Ordered set
 			for wall in combination[1:]:
-				main_wall['nodes'].extend(list(set(wall['nodes']) - set(main_wall['nodes'])))
+				main_nodes.update(dict.fromkeys(wall['nodes']))
+			main_wall['nodes'] = list(main_nodes)
 
 		# 6. Rotate by average bearing
+		# Corners are numbered by index, and the rotated x and y coordinates are kept in two parallel lists
 
-		for node, corner in iter(corners.items()):
-			corner['new_node'] = rotate_node(axis, avg_bearing, node)
+		corner_nodes = list(corners)
+		corner_index = { node: i for i, node in enumerate(corner_nodes) }
+		rotated = rotate_nodes(axis, avg_bearing, corner_nodes)
+		new_x = [ node[0] for node in rotated ]
+		new_y = [ node[1] for node in rotated ]
 
 		# 7. Rectify nodes
 
@@ -1208,53 +1548,62 @@ def rectify_buildings():
 #				building_test['properties']['TEST_45'] = "%.1f" % (wall['bearing'] - avg_bearing)
 #				continue
 
-			# Calculate x and y means of all nodes in wall
-			x = statistics.mean([ corners[node]['new_node'][0] for node in wall['nodes'] ])
-			y = statistics.mean([ corners[node]['new_node'][1] for node in wall['nodes'] ])
+			wall_index = [ corner_index[ node ] for node in wall['nodes'] ]
 
-			# Align y and x coordinate for y and x axis, respectively
-			for node in wall['nodes']:  
-				if wall['axis'] == 1:
-					corners[ node ]['new_node'] = ( corners[ node ]['new_node'][0], y)
-				else:
-					corners[ node ]['new_node'] = ( x, corners[ node ]['new_node'][1])
+			# Align y and x coordinate to mean of all nodes in wall for y and x axis, respectively
+			if wall['axis'] == 1:
+				y = mean([ new_y[i] for i in wall_index ])
+				for i in wall_index:
+					new_y[i] = y
+			else:
+				x = mean([ new_x[i] for i in wall_index ])
+				for i in wall_index:
+					new_x[i] = x
 
-		# 8. Rotate back
+		# 8. Rotate back, round and get relocation (squared distance) of each corner in one pass
 
-		for node, corner in iter(corners.items()):
-			corner['new_node'] = rotate_node(axis, - avg_bearing, corner['new_node'])
-			corner['new_node'] = ( round(corner['new_node'][0], coordinate_decimals), round(corner['new_node'][1], coordinate_decimals) )
+		new_nodes = []
+		relocations = []
+		decimals = coordinate_decimals  # Local names in loop
+		round_coordinate = round
+		for node, (x, y) in zip(corner_nodes, rotate_nodes(axis, - avg_bearing, zip(new_x, new_y))):
+			new_node = ( round_coordinate(x, decimals), round_coordinate(y, decimals) )
+			new_nodes.append(new_node)
+			relocations.append(distance_squared(node, new_node))
 
 		# 9. Construct new polygons
 
-		# Check if relocated nodes are off
-		relocated = 0
-		for building in building_group:
-			for i, polygon in enumerate(building['geometry']['coordinates']):
-				for node in polygon:
-					if node in corners:
-						relocated = max(relocated, distance(node, corners[node]['new_node']))
+		# Check if relocated nodes are off. All remaining corners are nodes of the polygons in the group.
+		relocated = 6371000.0 * math.sqrt(max(relocations, default=0))  # Metres
 
 		if relocated  < rectify_margin:
 
 			# Construct new polygons
 
+			get_corner_index = corner_index.get
+
 			for building in building_group:
 				relocated = 0
 				for i, polygon in enumerate(building['geometry']['coordinates']):
 					new_polygon = []
+					append_node = new_polygon.append
 					for node in polygon:
-						if node in corners:
-							new_polygon.append(corners[node]['new_node'])
-							relocated = max(relocated, distance(node, corners[node]['new_node']))
+						index = get_corner_index(node)  # Integer id of corner, hashing node tuple only once
+						if index is not None:
+							append_node(new_nodes[index])
+							if relocations[index] > relocated:
+								relocated = relocations[index]
  
-					if new_polygon[0] != new_polygon[-1]:  # First + last node were removed
+					# First + last node were removed. Same corner gives same tuple, so test identity first.
+					if new_polygon and new_polygon[0] is not new_polygon[-1] and new_polygon[0] != new_polygon[-1]:
 						new_polygon.append(new_polygon[0])
 
 					building['geometry']['coordinates'][i] = new_polygon
 
+				relocated = 6371000.0 * math.sqrt(relocated)  # Metres
 				building['rectified'] = "done"  # Do not test again
-				building['properties']['DEBUG_RECTIFY'] = "%.2f" % relocated
+				if debug:
+					building['properties']['DEBUG_RECTIFY'] = "%.2f" % relocated
 				count_rectify += 1
 
 				if relocated  > 0.5 * rectify_margin:
@@ -1271,6 +1620,26 @@ def rectify_buildings():
 
 
 
+# Remove temporary data and upper case debug tags from building, in place to avoid a copy of all buildings while saving.
+# Returns the same building.
+
+def prune_building(building):
+
+	# Delete temporary data
+	for key in [ key for key in building if key not in feature_keys ]:
+		del building[key]
+
+	# Delete upper case debug tags
+	if not debug:
+		properties = building['properties']
+		for key in [ key for key in properties if key == key.upper() and key not in upper_case_tags and \
+						not (verify and "VERIFY" in key) and not (original and key == "SEFRAK") ]:
+			del properties[key]
+
+	return building
+
+
+
 # Output geojson file
 
 def save_file(municipality_id, municipality_name):
@@ -1286,30 +1655,13 @@ def save_file(municipality_id, municipality_name):
 	message ("Saving buildings ...\n")
 	message ("\tFilename: '%s'\n" % filename)
 
+	# Prepare buildings to fit geosjon data structure
+
 	features = {
 		"type": "FeatureCollection",
-		"features": []
+		"features": [ prune_building(building) for building in buildings.values() if building['geometry']['coordinates'] ]
 	}
-
-	# Prepare buildings to fit geosjon data structure
-
-	count = 0
-	for ref, building in iter(buildings.items()):
-		if building['geometry']['coordinates']:
-			count += 1
-
-			# Delete temporary data
-			for key in list(building.keys()):
-				if key not in ['type', 'geometry', 'properties']:
-					del building[key]
-
-			# Delete upper case debug tags		
-			if not debug:
-				for key in list(building['properties'].keys()):
-					if key == key.upper() and key not in ['TYPE', 'STATUS', 'DATE'] and \
-							not(verify and "VERIFY" in key) and not(original and key == "SEFRAK"):
-						del building['properties'][key]
-			features['features'].append(building)
+	count = len(features['features'])
 
 	# Add removed nodes, for debugging
 
@@ -1327,9 +1679,14 @@ def save_file(municipality_id, municipality_name):
 			}
 			features['features'].append(feature)
 
-	file_out = open(filename, "w")
-	json.dump(features, file_out, indent=2, ensure_ascii=False)
-	file_out.close()
+	# Encode whole file in memory and write it in one call
+	if orjson:
+		output = orjson.dumps(features, option=orjson.OPT_INDENT_2)
+	else:
+		output = json.dumps(features, indent=2, ensure_ascii=False, check_circular=False).encode("utf-8")
+
+	with open(filename, "wb") as file_out:
+		file_out.write(output)
 
 	message ("\tSaved %i buildings\n" % count)
 
@@ -1344,6 +1701,7 @@ def process_municipality(municipality_id, municipality_name):
 	neighbour_buildings.clear()
 	dwellings.clear()
 	remove_nodes.clear()
+	shared_nodes.clear()
 
 	count = load_building_info(municipality_id, municipality_name, neighbour=False)
 
@@ -1360,6 +1718,13 @@ def process_municipality(municipality_id, municipality_name):
 			rectify_buildings()
 			simplify_buildings()
 
+		# Release data not needed for output, to lower peak memory while saving
+		neighbour_buildings.clear()
+		dwellings.clear()
+		shared_nodes.clear()
+		if not (debug or verify):
+			remove_nodes.clear()
+
 		save_file(municipality_id, municipality_name)
 
 		message("Done in %s\n\n\n" % timeformat(time.time() - mun_start_time))
@@ -1381,6 +1746,7 @@ if __name__ == '__main__':
 	neighbour_buildings = []
 	dwellings = {}
 	remove_nodes = set()
+	shared_nodes = {}	# One tuple per coordinate, shared by all buildings using the node
 	failed_runs = []
 
 	addr = {}
@@ -125,6 +125,56 @@ def line_distance(s1, s2, p3):
 	return distance
 
 
+# Project polygon to plane and prepare its line segments, for repeated distance tests against the same polygon.
+# Same simplified reprojection of latitude as in line_distance().
+# Returns list of projected nodes and list of segments.
+
+def polygon_segments(polygon):
+
+	projected = []
+	for node in polygon:
+		x, y = math.radians(node[0]), math.radians(node[1])
+		projected.append((x * math.cos(y), y))
+
+	segments = []
+	for (x1, y1), (x2, y2) in zip(projected, projected[1:]):
+		dx = x2 - x1
+		dy = y2 - y1
+		segments.append((x1, y1, x2, y2, dx, dy, dx*dx + dy*dy))
+
+	return (projected, segments)
+
+
+
+# Compute closest distance from projected point to projected line segment.
+# Same result as line_distance(), for input from polygon_segments().
+
+def segment_distance(segment, point):
+
+	x1, y1, x2, y2, dx, dy, len_sq = segment
+	x3, y3 = point
+
+	if len_sq != 0:  # in case of zero length line
+		param = ((x3 - x1)*dx + (y3 - y1)*dy) / len_sq
+	else:
+		param = -1
+
+	if param < 0:
+		x4 = x1
+		y4 = y1
+	elif param > 1:
+		x4 = x2
+		y4 = y2
+	else:
+		x4 = x1 + param * dx
+		y4 = y1 + param * dy
+
+	x = x4 - x3
+	y = y4 - y3
+	return 6371000 * math.sqrt( x*x + y*y )  # In meters
+
+
+
 # Calculate coordinate area of polygon in square meters
 # Simple conversion to planar projection, works for small areas
 # < 0: Clockwise
@@ -136,15 +186,15 @@ def polygon_area (polygon):
 	if polygon and polygon[0] == polygon[-1]:
 		lat_dist = math.pi * 6371009.0 / 180.0
 
-		coord = []
-		for node in polygon:
-			y = node[1] * lat_dist
-			x = node[0] * lat_dist * math.cos(math.radians(node[1]))
-			coord.append((x,y))
-
+		# Single pass, carrying projected coordinates of previous node. First term is zero.
 		area = 0.0
-		for i in range(len(coord) - 1):
-			area += (coord[i+1][0] - coord[i][0]) * (coord[i+1][1] + coord[i][1])  # (x2-x1)(y2+y1)
+		x1 = polygon[0][0] * lat_dist * math.cos(math.radians(polygon[0][1]))
+		y1 = polygon[0][1] * lat_dist
+		for lon, lat in polygon:
+			x2 = lon * lat_dist * math.cos(math.radians(lat))
+			y2 = lat * lat_dist
+			area += (x2 - x1) * (y2 + y1)  # (x2-x1)(y2+y1)
+			x1, y1 = x2, y2
 
 		return int(area / 2.0)
 	else:
@@ -228,6 +278,10 @@ def hausdorff_distance(p1, p2):
 	N1 = len(p1) - 1
 	N2 = len(p2) - 1
 
+	# Project nodes and prepare segments once, instead of for each pair of node and segment
+	nodes1, segments1 = polygon_segments(p1)
+	nodes2, segments2 = polygon_segments(p2)
+
 # Shuffling for small lists disabled
 #	random.shuffle(p1)
 #	random.shuffle(p2)
@@ -239,7 +293,7 @@ def hausdorff_distance(p1, p2):
 
 		for j in range(N2):
 
-			d = line_distance(p2[j], p2[j+1], p1[i])
+			d = segment_distance(segments2[j], nodes1[i])
     
 			if d < cmax: 
 				no_break = False
@@ -259,7 +313,7 @@ def hausdorff_distance(p1, p2):
 
 		for j in range(N1):
 
-			d = line_distance(p1[j], p1[j+1], p2[i])
+			d = segment_distance(segments1[j], nodes2[i])
     
 			if d < cmax:
 				no_break = False
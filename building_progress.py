@@ -11,11 +11,10 @@ import sys
 import time
 from datetime import date
 import urllib.request
-import zipfile
 import os.path
-from io import BytesIO
 from xml.etree import ElementTree as ET
 from bs4 import BeautifulSoup
+from building2osm import open_zip_url
 
 
 version = "0.4.1"
@@ -208,8 +207,8 @@ def count_import_buildings():
 		url = url.replace("Æ", " E").replace("Ø", "O").replace(
 			"Å", "A").replace("æ", "e").replace("ø", "o").replace("å", "a").replace(" ", "_")
 
-		in_file = urllib.request.urlopen(url)
-		zip_file = zipfile.ZipFile(BytesIO(in_file.read()))
+		# Download to temporary file instead of reading it all into memory
+		zip_file = open_zip_url(url)
 
 		if len(zip_file.namelist()) == 0:
 			message("*** No data\n")
@@ -219,15 +218,21 @@ def count_import_buildings():
 		filename = zip_file.namelist()[0]
 		file = zip_file.open(filename)
 
-		tree = ET.parse(file)
-		file.close()
-		root = tree.getroot()
+		# Count number of import buildings and compare with last update.
+		# Parse features one by one without building the full tree.
+
+		member_tag = '{%s}featureMember' % ns_gml
+		context = ET.iterparse(file, events=("start", "end"))
+		event, root = next(context)
 		count = 0
 
-		# Count number of import buildings and compare with last update
+		for event, element in context:
+			if event == "end" and element.tag == member_tag:
+				count += 1
+				root.clear()
 
-		for _ in root.iter('{%s}featureMember' % ns_gml):
-			count += 1
+		file.close()
+		zip_file.close()
 
 		message(f"{count:,}".replace(',', ' '))
 		if count != municipality['import_buildings']:
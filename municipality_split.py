@@ -1,17 +1,33 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from io import BytesIO
 from zipfile import ZipFile
 import os.path
+import time
+import gzip
+import shutil
+import hashlib
 import json
 import argparse
 import itertools
+from operator import itemgetter
 from collections import defaultdict
-from typing import Tuple, List, Iterable, Iterator, Collection, Sequence, TypedDict, Dict, NamedTuple, Literal, Union
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, List, Iterable, Iterator, Collection, Sequence, TypedDict, Dict, NamedTuple, Literal, Union, BinaryIO
 import utm
 try:
 	from lxml import etree
 except ImportError:
 	import xml.etree.ElementTree as etree
+try:
+	import ijson
+except ImportError:
+	ijson = None
+try:
+	import orjson
+except ImportError:
+	orjson = None
 
 
 version = "1.3.1"
@@ -102,6 +118,9 @@ class Bbox(NamedTuple):
 
 city_with_bydel_id = {"0301", "1103", "3005", "4601", "5001"}
 overpass_endpoint = "https://overpass.kumi.systems/api/interpreter"
+overpass_cache_folder = ".overpass_cache"  # Folder for cached Overpass responses
+overpass_cache_age = 7 * 24 * 3600  # Max age of cached Overpass responses (seconds)
+parallel_relations = 50  # Min number of relations before polygons are assembled in worker processes
 query_template = """
 [out:json][timeout:40];
 (area[ref={}][admin_level=7][place=municipality];)->.a;
@@ -112,6 +131,19 @@ out skel qt;
 """
 
 
+def create_session() -> requests.Session:
+	"""Session with pooled connections and retry/backoff on throttled or failing servers"""
+	retry = Retry(total=5, backoff_factor=1.0, status_forcelist=(429, 502, 503, 504))
+	adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+
+	session = requests.Session()
+	session.mount('https://', adapter)
+	session.headers.update({
+		'User-Agent': f'building2osm/split/{version}'
+	})
+	return session
+
+
 def pairwise(iterable: Iterable) -> Iterator:
 	a, b = itertools.tee(iterable)
 	next(b)
@@ -211,12 +243,15 @@ def inside_linear_ring(point: PointCoord, linear_ring: LinearRingCoord):
 	px, py = point
 	inside = False
 
-	for (xi, yi), (xj, yj) in pairwise(linear_ring):
-		if (
-				((yi > py) != (yj > py)) and
-				(px < (xj - xi) * (py - yi) / (yj - yi) + xi)
-		):
+	# Walk the ring once, carrying the previous vertex and its side of the ray.
+	# The first step pairs the start vertex with itself and never toggles.
+	xi, yi = linear_ring[0]
+	above_i = yi > py
+	for xj, yj in linear_ring:
+		above_j = yj > py
+		if above_i != above_j and px < (xj - xi) * (py - yi) / (yj - yi) + xi:
 			inside = not inside
+		xi, yi, above_i = xj, yj, above_j
 
 	return inside
 
@@ -231,6 +266,7 @@ def inside_polygon(point: PointCoord, polygon: PolygonCoord, bbox: Bbox = None):
 		for inner_ring in polygon[1:]:
 			if inside_linear_ring(point, inner_ring):
 				inside = False
+				break
 	return inside
 
 
@@ -243,69 +279,140 @@ def inside_multipolygon(point: PointCoord, multipolygon: MultipolygonCoord, bbox
 	return inside
 
 
-def city_subdivisions_request(session: requests.Session, city_id: str):
-	params = {"data": query_template.format(city_id)}
-	response = session.get(overpass_endpoint, params=params)
-	return response.json()
+def overpass_elements(file: BinaryIO) -> Iterator[OsmElement]:
+	"""Parse elements incrementally from the file if ijson is available"""
+	with file:
+		if ijson:
+			yield from ijson.items(file, 'elements.item', use_float=True)
+		else:
+			yield from load_json(file.read())['elements']
+
+
+def overpass_remark(file: BinaryIO) -> Union[str, None]:
+	"""Return remark of Overpass response, which reports errors such as timeouts. Fails if the json is incomplete."""
+	with file:
+		if ijson:
+			for prefix, event, value in ijson.parse(file):
+				if prefix == 'remark' and event == 'string':
+					return value
+			return None
+		else:
+			return load_json(file.read()).get('remark')
+
+
+def overpass_request(session: requests.Session, query: str) -> BinaryIO:
+	"""Open Overpass response for query, cached on disk by hash of the query. Responses with errors are not cached."""
+	key = hashlib.sha256(query.encode('utf-8')).hexdigest()
+	cache_filename = os.path.join(overpass_cache_folder, f'{key}.json.gz')
+
+	if not os.path.isfile(cache_filename) or time.time() - os.path.getmtime(cache_filename) > overpass_cache_age:
+		os.makedirs(overpass_cache_folder, exist_ok=True)
+		temp_filename = cache_filename + '.tmp'
+		try:
+			with session.get(overpass_endpoint, params={"data": query}, stream=True) as response:
+				response.raise_for_status()
+				response.raw.decode_content = True
+				with gzip.open(temp_filename, 'wb') as file:
+					shutil.copyfileobj(response.raw, file)
+			remark = overpass_remark(gzip.open(temp_filename, 'rb'))
+			if remark:
+				raise RuntimeError(f'Overpass error: {remark}')
+		except BaseException:
+			if os.path.exists(temp_filename):
+				os.remove(temp_filename)
+			raise
+		os.replace(temp_filename, cache_filename)
+
+	return gzip.open(cache_filename, 'rb')
+
+
+def city_subdivisions_request(session: requests.Session, city_id: str) -> Iterator[OsmElement]:
+	file = overpass_request(session, query_template.format(city_id))
+	return overpass_elements(file)
 
 
 def osm_type_sorter(elements: Iterable[OsmElement]):
+	"""Sort elements by type. Only the (lon, lat) coordinate is kept for nodes."""
 	relations: Dict[int, Relation] = {}
 	ways: Dict[int, Way] = {}
-	nodes: Dict[int, Node] = {}
-	switch = {
-		"relation": relations,
-		"way": ways,
-		"node": nodes
-	}
+	nodes: Dict[int, PointCoord] = {}
+	lon_lat = itemgetter("lon", "lat")
 
+	# Ordered by frequency in Overpass output
 	for element in elements:
 		osmtype = element["type"]
-		osmid = element["id"]
-		switch[osmtype][osmid] = element
+		if osmtype == "node":
+			nodes[element["id"]] = lon_lat(element)
+		elif osmtype == "way":
+			ways[element["id"]] = element
+		elif osmtype == "relation":
+			relations[element["id"]] = element
+		else:
+			raise RuntimeError(f'OSM element type {osmtype} not known')
 
 	return nodes, ways, relations
 
 
-def connections(relation_ways: Iterable[Way]):
-	end_nodes = defaultdict(set)
+def add_connection(end_nodes: Dict[int, List[Tuple[int, bool]]], row: int, nodes: List[int]):
+	"""Forward is True if the way starts at the end node"""
+	end_nodes[nodes[0]].append((row, True))
+	end_nodes[nodes[-1]].append((row, False))
+
 
-	for way in relation_ways:
-		way_id = way['id']
-		for i in (0, -1):
-			end_node_id = way['nodes'][i]
-			end_nodes[end_node_id].add(way_id)
+def connections(way_nodes: Sequence[List[int]]) -> Dict[int, List[Tuple[int, bool]]]:
+	"""Index of (way row, forward) by end node"""
+	end_nodes = defaultdict(list)
+
+	for row, nodes in enumerate(way_nodes):
+		add_connection(end_nodes, row, nodes)
 
 	return end_nodes
 
 
-def linear_rings_assembler(relation_ways: Sequence[Way]) -> List[List[int]]:
-	current_way = relation_ways[0]
+def linear_rings_assembler(
+		relation_ways: Sequence[Way],
+		end_nodes: Dict[int, List[Tuple[int, bool]]] = None
+) -> List[List[int]]:
+	"""end_nodes may be given if already built by the caller, it will be consumed"""
+
+	# Work on way rows (parallel lists) rather than on the way dicts
+	way_nodes = [way['nodes'] for way in relation_ways]
+	used = [False] * len(way_nodes)
+	next_unused = 0
 
-	end_nodes = connections(relation_ways)
-	unused = {w['id']: w for w in relation_ways}
-	current_ring = [current_way['nodes'][0]]
+	# Consumed ways are removed from the index, so any remaining entry is a candidate
+	end_nodes = end_nodes if end_nodes is not None else connections(way_nodes)
+	current = 0
+	forward = True
+	current_ring = [way_nodes[current][0]]
 	rings = [current_ring]
 
-	for _ in range(len(relation_ways)):
-		current_ring.extend(current_way['nodes'][1:])
+	for _ in range(len(way_nodes)):
+		nodes = way_nodes[current]
+		# Skip the shared end node without copying the way into a slice first
+		if forward:
+			current_ring.extend(itertools.islice(nodes, 1, None))
+		else:
+			current_ring.extend(itertools.islice(reversed(nodes), 1, None))
 		last_node = current_ring[-1]
 
-		del unused[current_way['id']]
+		used[current] = True
+		end_nodes[nodes[0]].remove((current, True))
+		end_nodes[nodes[-1]].remove((current, False))
 
 		if current_ring[0] != last_node:
-			connected_way_ids = end_nodes[last_node] - {current_way['id']}
-			connected_way = next(unused[w_id] for w_id in connected_way_ids)
-			if connected_way['nodes'][0] == last_node:
-				current_way = connected_way
-			elif connected_way['nodes'][-1] == last_node:
-				connected_way['nodes'] = list(reversed(connected_way['nodes']))
-				current_way = connected_way
-
-		elif unused:
-			current_way = next(iter(unused.values()))
-			current_ring = [current_way['nodes'][0]]
-			rings.append(current_ring)
+			if not end_nodes[last_node]:
+				break
+			current, forward = end_nodes[last_node][0]
+
+		else:
+			while next_unused < len(used) and used[next_unused]:
+				next_unused += 1
+			if next_unused < len(used):
+				current = next_unused
+				forward = True
+				current_ring = [way_nodes[current][0]]
+				rings.append(current_ring)
 
 	if current_ring[0] != current_ring[-1]:
 		raise RuntimeError('Invalid polygon - ring not closed')
@@ -313,28 +420,37 @@ def linear_rings_assembler(relation_ways: Sequence[Way]) -> List[List[int]]:
 	return rings
 
 
+def ring_coordinates(ring: Iterable[int], nodes: Dict[int, PointCoord]) -> LinearRingCoord:
+	"""Gather (lon, lat) of the ring nodes, looking up all nodes in one C-level map"""
+	return list(map(nodes.__getitem__, ring))
+
+
 def polygon_assembler(
 		members: Iterable[RelationMember],
 		ways: Dict[int, Way],
-		nodes: Dict[int, Node]
+		nodes: Dict[int, PointCoord]
 ) -> Union[PolygonGeometry, MultipolygonGeometry]:
 
 	outer_way = []
 	inner_way = []
-	switch = defaultdict(list, {
-		"": outer_way,
-		"outer": outer_way,
-		"inner": inner_way,
-	})
-
-	for member in filter(lambda m: m['type'] == 'way', members):
-		way = ways[member['ref']]
-		switch[member['role']].append(way)
-
-	coordinates = [
-		[((node := nodes[node_id])['lon'], node['lat']) for node_id in ring]
-		for ring in linear_rings_assembler(outer_way)
-	]
+	outer_end_nodes = defaultdict(list)
+	inner_end_nodes = defaultdict(list)
+
+	# Index end nodes per role while collecting the ways
+	for member in members:
+		if member['type'] != 'way':
+			continue
+		role = member['role']
+		if role == "outer" or role == "":
+			way = ways[member['ref']]
+			add_connection(outer_end_nodes, len(outer_way), way['nodes'])
+			outer_way.append(way)
+		elif role == "inner":
+			way = ways[member['ref']]
+			add_connection(inner_end_nodes, len(inner_way), way['nodes'])
+			inner_way.append(way)
+
+	coordinates = [ring_coordinates(ring, nodes) for ring in linear_rings_assembler(outer_way, outer_end_nodes)]
 	if len(coordinates) > 1:
 		geometry_type = "MultiPolygon"
 		coordinates = [[ring] for ring in coordinates]
@@ -344,23 +460,77 @@ def polygon_assembler(
 		geometry_type = "Polygon"
 		if inner_way:
 			coordinates.extend(
-				[((node := nodes[node_id])['lon'], node['lat']) for node_id in ring]
-				for ring in linear_rings_assembler(inner_way)
+				ring_coordinates(ring, nodes) for ring in linear_rings_assembler(inner_way, inner_end_nodes)
 			)
 
 	return {'type': geometry_type, 'coordinates': coordinates}
 
 
+def relation_subset(
+		members: Iterable[RelationMember],
+		ways: Dict[int, Way],
+		nodes: Dict[int, PointCoord]
+) -> Tuple[Dict[int, Way], Dict[int, PointCoord]]:
+	"""Ways and nodes used by relation, to limit data sent to worker processes"""
+	way_subset = {member['ref']: ways[member['ref']] for member in members if member['type'] == 'way'}
+	node_subset = {node_id: nodes[node_id] for way in way_subset.values() for node_id in way['nodes']}
+	return way_subset, node_subset
+
+
 def overpass2features(elements: Iterable[OsmElement]) -> Iterator[Feature]:
 	nodes, ways, relations = osm_type_sorter(elements)
-	for relation in relations.values():
-		geometry = polygon_assembler(relation['members'], ways, nodes)
+
+	if len(relations) >= parallel_relations:
+		members = [relation['members'] for relation in relations.values()]
+		subsets = [relation_subset(relation_members, ways, nodes) for relation_members in members]
+		with ProcessPoolExecutor() as executor:
+			geometries = list(executor.map(
+				polygon_assembler,
+				members,
+				(way_subset for way_subset, node_subset in subsets),
+				(node_subset for way_subset, node_subset in subsets)
+			))
+	else:
+		geometries = (polygon_assembler(relation['members'], ways, nodes) for relation in relations.values())
+
+	for relation, geometry in zip(relations.values(), geometries):
 		properties = relation['tags']
 		yield {'type': 'Feature', 'geometry': geometry, 'properties': properties}
 
 
-def features2geojson(features: Iterable[Feature]) -> FeatureCollection:
-	return {"type": "FeatureCollection", "features": list(features)}
+def load_json(content: bytes):
+	"""Parse json, with orjson if available"""
+	return orjson.loads(content) if orjson else json.loads(content)
+
+
+def dump_feature(feature: Feature) -> bytes:
+	"""Serialize feature to indented utf-8 json at the level of the features list, with orjson if available"""
+	if orjson:
+		content = orjson.dumps(feature, option=orjson.OPT_INDENT_2)
+	else:
+		content = json.dumps(feature, indent=2, ensure_ascii=False).encode('utf-8')
+	return content.replace(b'\n', b'\n    ')
+
+
+def save_features(features: Iterable[Feature], filename: str) -> int:
+	"""Stream features to an indented geojson file one feature at a time, returns number of features saved"""
+	count = 0
+	with open(filename, 'wb') as file:
+		file.write(b'{\n  "type": "FeatureCollection",\n  "features": [')
+		for feature in features:
+			file.write(b',\n    ' if count else b'\n    ')
+			file.write(dump_feature(feature))
+			count += 1
+		file.write(b'\n  ]\n}' if count else b']\n}')
+
+	return count
+
+
+def track_refs(buildings: Iterable[Feature], refs: set) -> Iterator[Feature]:
+	"""Pass buildings through while collecting their refs"""
+	for building in buildings:
+		refs.add(building['properties']['ref:bygningsnr'])
+		yield building
 
 
 def building_center(building: Feature) -> PointCoord:
@@ -606,7 +776,7 @@ def load_municipalities(session: requests.Session) -> Dict[str, str]:
 	url = "https://ws.geonorge.no/kommuneinfo/v1/fylkerkommuner"
 	params = {"filtrer": ','.join(("fylkesnummer", "fylkesnavn", "kommuner.kommunenummer", "kommuner.kommunenavnNorsk"))}
 	response = session.get(url, params=params)
-	data = response.json()
+	data = load_json(response.content)
 
 	municipalities = {}
 
@@ -663,10 +833,7 @@ def get_arguments() -> argparse.Namespace:
 def main():
 	arguments = get_arguments()
 
-	session = requests.Session()
-	session.headers.update({
-		'User-Agent': f'building2osm/split/{version}'
-	})
+	session = create_session()
 
 	# Get municipality
 
@@ -683,9 +850,9 @@ def main():
 		if municipality_id not in city_with_bydel_id:
 			raise RuntimeError(f'Only the municipalities with these ids have "bydeler" {city_with_bydel_id}')
 		subdivision_plural = 'bydeler'
-		overpass_json = city_subdivisions_request(session, municipality_id)
+		elements = city_subdivisions_request(session, municipality_id)
+		subdivisions = overpass2features(elements)
 		print(f"Loaded {subdivision_plural} from overpass api")
-		subdivisions = overpass2features(overpass_json['elements'])
 
 	elif arguments.subdivision == 'postnummer':
 		subdivision_plural = 'postnummere'
@@ -705,11 +872,10 @@ def main():
 
 	# Output subdivision polygons
 
-	geojson = features2geojson(subdivisions)
-	subdivisions = geojson['features']
+	if not arguments.save_area:
+		subdivisions = list(subdivisions)  # Geometries are needed again for splitting
 	out_filename = f'{subdivision_plural}_{municipality_id}_{municipality_name}.geojson'.replace(" ", "_")
-	with open(out_filename, 'w', encoding='utf-8') as file:
-		json.dump(geojson, file, indent=2, ensure_ascii=False)
+	save_features(subdivisions, out_filename)
 	print(f'Saved subdivision areas to "{out_filename}"\n')
 
 	if arguments.save_area:
@@ -722,8 +888,8 @@ def main():
 		if os.path.isfile(test_filename):
 			filename = test_filename
 
-	with open(filename, 'r', encoding='utf-8') as file:
-		input_geojson: FeatureCollection = json.load(file)
+	with open(filename, 'rb') as file:
+		input_geojson: FeatureCollection = load_json(file.read())
 
 	buildings = input_geojson['features']
 
@@ -736,30 +902,26 @@ def main():
 	imported_refs = set()
 	for subdivision in subdivisions:
 		relevant_buildings = buildings_inside_subdivision(buildings, subdivision)
-		geojson = features2geojson(relevant_buildings)
+		relevant_buildings = track_refs(relevant_buildings, imported_refs)
 		subdivision_name = subdivision['properties']['name']
-		imported_refs.update(b['properties']['ref:bygningsnr'] for b in geojson['features'])
 
 		filename = (
 			f'bygninger_{municipality_id}_{municipality_name.replace(" ", "_")}_'
 			f'{arguments.subdivision}_{subdivision_name.replace(" ", "_").replace("/", "-").replace(",", "")}.geojson'
 		)
-		with open(filename, 'w', encoding='utf-8') as file:
-			json.dump(geojson, file, indent=2, ensure_ascii=False)
+		count = save_features(relevant_buildings, filename)
 
-		print(f"\tSaved {len(geojson['features'])} buildings to '{filename}'")
+		print(f"\tSaved {count} buildings to '{filename}'")
 
 	leftover_buildings = [b for b in buildings if b['properties']['ref:bygningsnr'] not in imported_refs]
 	if leftover_buildings:
-		geojson = features2geojson(leftover_buildings)
 		filename = (
 			f'bygninger_{municipality_id}_{municipality_name.replace(" ", "_")}_'
 			f'{arguments.subdivision.replace(" ", "_").replace("/", "-").replace(",", "")}_andre.geojson'
 		)
-		with open(filename, 'w', encoding='utf-8') as file:
-			json.dump(geojson, file, indent=2, ensure_ascii=False)
+		count = save_features(leftover_buildings, filename)
 
-		print(f"\tSaved {len(geojson['features'])} leftover buildings to '{filename}'")
+		print(f"\tSaved {count} leftover buildings to '{filename}'")
 	
 	print("")
 
@@ -0,0 +1,116 @@
+import statistics
+import math
+import os
+import zipfile
+from io import BytesIO
+import building2osm
+from building2osm import bearing, distance, distance_squared, polygon_radians, polygon_bearings, polygon_distances, polygon_turns, \
+	bearing_difference, simplify_polygon, parse_polygon, mean, median_low, rotate_node, rotate_nodes, partition_centres
+
+polygon = [(10.7183, 59.8111), (10.7185, 59.8111), (10.7186, 59.8113), (10.7183, 59.8112), (10.7183, 59.8111)]
+
+
+def test_polygon_bearings():
+	expected = [bearing(polygon[i], polygon[i + 1]) for i in range(len(polygon) - 1)]
+	assert polygon_bearings(polygon) == expected
+	assert polygon_bearings(polygon, polygon_radians(polygon)) == expected
+
+
+def test_polygon_distances():
+	expected = [distance(polygon[i], polygon[i + 1]) for i in range(len(polygon) - 1)]
+	assert polygon_distances(polygon) == expected
+	assert polygon_distances(polygon, polygon_radians(polygon)) == expected
+
+
+def test_polygon_turns():
+	bearings = polygon_bearings(polygon)
+	n = len(bearings)
+	assert polygon_turns(bearings) == [bearing_difference(bearings[(i - 1) % n], bearings[i]) for i in range(n)]
+	assert polygon_turns([]) == []
+
+
+def test_distance_squared():
+	for node in polygon:
+		assert distance(polygon[0], node) == 6371000.0 * math.sqrt(distance_squared(polygon[0], node))
+
+
+def test_simplify_polygon():
+	line = [(10.0, 59.0), (10.0001, 59.0000001), (10.0002, 59.0), (10.0002, 59.0001), (10.0, 59.0)]
+	assert simplify_polygon(line, 0.05) == [line[0], line[2], line[3], line[4]]
+	assert simplify_polygon(line, 0.001) == line
+
+
+def test_parse_polygon():
+	text = "10.1 59.1 10.1 59.1 10.2 59.1 10.3 59.2 10.2 59.1 10.1 59.2 10.1 59.1"
+	assert parse_polygon(text) == [(10.1, 59.1), (10.2, 59.1), (10.1, 59.2), (10.1, 59.1)]
+	assert parse_polygon("10.1 59.1 10.2 59.1 10.1 59.2 10.1 59.1") == [(10.1, 59.1), (10.2, 59.1), (10.1, 59.2), (10.1, 59.1)]
+	assert parse_polygon("10.1 59.1 10.2 59.1 10.1 59.1") == [(10.1, 59.1)]
+
+
+def test_mean():
+	for values in ([3.0], [59.9071256, 59.907235, 59.9071979], [10.8157456, 10.8159926, 10.8159148, 10.8157071], [1e300, 1e300, -1e-300]):
+		assert mean(values) == statistics.mean(values)
+
+
+def test_median_low():
+	for values in ([3.0], [5.0, 1.0], [170.5, 10.0, 95.0, 10.0], [4, 1, 3, 2, 5]):
+		assert median_low(values) == statistics.median_low(values)
+
+
+def test_rotate_nodes():
+	axis = (10.7184, 59.8112)
+	for angle in (0.0, 17.3, -95.0):
+		rotated = rotate_nodes(axis, angle, polygon)
+		assert rotated == [rotate_node(axis, angle, node) for node in polygon]
+		for node, back in zip(polygon, rotate_nodes(axis, -angle, rotated)):
+			assert abs(node[0] - back[0]) < 1e-9 and abs(node[1] - back[1]) < 1e-9
+
+
+def test_partition_centres():
+	centres = [(10.1, 59.9), (10.3, 60.1), (10.2, 60.0)]
+	assert partition_centres(centres, 0, 10.2) == ([(10.1, 59.9)], [(10.3, 60.1), (10.2, 60.0)])
+	assert partition_centres(centres, 1, 60.05) == ([(10.1, 59.9), (10.2, 60.0)], [(10.3, 60.1)])
+
+
+def test_rectify_duplicate_buildings(monkeypatch):
+	# Walls of identical buildings are equal, and are not combined with each other
+	square = [(10.0, 60.0), (10.0002, 60.0), (10.0002, 60.0001), (10.0, 60.0001), (10.0, 60.0)]
+	buildings = {
+		ref: {'type': 'Feature', 'geometry': {'type': 'Polygon', 'coordinates': [list(square)]}, 'properties': {'ref:bygningsnr': ref}}
+		for ref in ("1", "2")
+	}
+	monkeypatch.setattr(building2osm, "buildings", buildings, raising=False)  # Globals are set up when run as script
+	monkeypatch.setattr(building2osm, "remove_nodes", set(), raising=False)
+	monkeypatch.setattr(building2osm, "debug", True)
+	building2osm.rectify_buildings()
+	for building in buildings.values():
+		assert building['rectified'] == "done"
+		assert "DEBUG_COMBINE" not in building['properties']
+
+
+def test_load_json_url_cached(tmp_path, monkeypatch):
+	calls = []
+
+	def urlopen(url):
+		calls.append(url)
+		return BytesIO(b'{"kommunenummer": "0301"}')
+
+	monkeypatch.setattr(building2osm, "cache_folder", str(tmp_path))
+	monkeypatch.setattr(building2osm.urllib.request, "urlopen", urlopen)
+	for _ in range(2):
+		assert building2osm.load_json_url("https://example.com/kommuner/0301") == {"kommunenummer": "0301"}
+
+	assert len(calls) == 1
+	assert [filename for filename in os.listdir(tmp_path) if not filename.endswith(".json")] == []  # No temporary file left
+
+
+def test_open_zip_url(monkeypatch):
+	content = BytesIO()
+	with zipfile.ZipFile(content, "w") as zip_file:
+		zip_file.writestr("buildings.gml", "<gml/>")
+
+	monkeypatch.setattr(building2osm.urllib.request, "urlopen", lambda url: BytesIO(content.getvalue()))
+	zip_file = building2osm.open_zip_url("https://example.com/buildings.zip")
+	with zip_file.open(zip_file.namelist()[0]) as file:
+		assert file.read() == b"<gml/>"
+	zip_file.fp.close()
@@ -0,0 +1,18 @@
+from building_merge import line_distance, polygon_segments, segment_distance, hausdorff_distance
+
+polygon = [(10.7183, 59.8111), (10.7185, 59.8111), (10.7186, 59.8113), (10.7183, 59.8112), (10.7183, 59.8111)]
+points = [(10.7184, 59.8112), (10.7190, 59.8100), (10.7183, 59.8111)]
+
+
+def test_segment_distance():
+	projected_points, _ = polygon_segments(points)
+	_, segments = polygon_segments(polygon)
+	for point, projected in zip(points, projected_points):
+		for j, segment in enumerate(segments):
+			assert segment_distance(segment, projected) == line_distance(polygon[j], polygon[j + 1], point)
+
+
+def test_hausdorff_distance():
+	assert hausdorff_distance(polygon, list(polygon)) == 0
+	moved = [(lon + 0.0001, lat) for lon, lat in polygon]
+	assert 5 < hausdorff_distance(polygon, moved) < 6
@@ -1,4 +1,11 @@
-from municipality_split import linear_rings_assembler, polygon_assembler, buildings_inside_subdivision
+import json
+import os
+from io import BytesIO
+import pytest
+import requests
+import municipality_split
+from municipality_split import linear_rings_assembler, polygon_assembler, buildings_inside_subdivision, save_features, \
+	overpass_request, overpass_elements, overpass2features, inside_polygon
 
 relation_ways = [
 	{"id": 500, "nodes": [1, 2, 3]},
@@ -7,7 +14,7 @@ relation_ways = [
 	{"id": 505, "nodes": [1, 9, 7]}
 ]
 test_ways = {way['id']: way for way in relation_ways}
-test_nodes = {node['id']: node for node in [
+test_nodes = {node['id']: (node['lon'], node['lat']) for node in [
 	{"type": "node", "id": 1, "lat": 59.8111, "lon": 10.7183},
 	{"type": "node", "id": 2, "lat": 59.8340, "lon": 10.8364},
 	{"type": "node", "id": 3, "lat": 59.8791, "lon": 10.9067},
@@ -48,6 +55,22 @@ def test_ring():
 	assert linear_rings_assembler(relation_ways) == expected
 
 
+def test_multiple_rings():
+	ways = [
+		{"id": 600, "nodes": [1, 2, 3]},
+		{"id": 601, "nodes": [10, 11, 12, 10]},
+		{"id": 602, "nodes": [1, 4, 3]}
+	]
+	expected = [[1, 2, 3, 4, 1], [10, 11, 12, 10]]
+	assert linear_rings_assembler(ways) == expected
+
+
+def test_ring_not_closed():
+	ways = [{"id": 700, "nodes": [1, 2, 3]}, {"id": 701, "nodes": [3, 4]}]
+	with pytest.raises(RuntimeError):
+		linear_rings_assembler(ways)
+
+
 def test_polygon():
 	expected = {
 		"type": "Polygon",
@@ -68,3 +91,83 @@ def test_buildings_inside_polygon():
 		'geometry': geometry
 	}
 	assert buildings_inside_subdivision(buildings, subdivision)
+
+
+def test_inside_polygon():
+	outer = [(0.0, 0.0), (4.0, 0.0), (4.0, 4.0), (0.0, 4.0), (0.0, 0.0)]
+	inner = [(1.0, 1.0), (2.0, 1.0), (2.0, 2.0), (1.0, 2.0), (1.0, 1.0)]
+	assert inside_polygon((3.0, 3.0), [outer, inner])
+	assert not inside_polygon((1.5, 1.5), [outer, inner])
+	assert not inside_polygon((5.0, 3.0), [outer, inner])
+
+
+def test_save_features(tmp_path, monkeypatch):
+	# Same output as indented json of the whole feature collection
+	expected = json.dumps({'type': 'FeatureCollection', 'features': [building, building]}, indent=2, ensure_ascii=False)
+
+	filename = tmp_path / "buildings.geojson"
+	assert save_features(iter([building, building]), filename) == 2
+	with open(filename, encoding='utf-8') as file:
+		assert file.read() == expected
+
+	monkeypatch.setattr(municipality_split, 'orjson', None)
+	assert save_features([building, building], filename) == 2
+	with open(filename, encoding='utf-8') as file:
+		assert file.read() == expected
+
+	assert save_features([], filename) == 0
+	with open(filename, encoding='utf-8') as file:
+		assert file.read() == json.dumps({'type': 'FeatureCollection', 'features': []}, indent=2)
+
+
+class FakeSession:
+	def __init__(self, content):
+		self.content = content
+		self.calls = 0
+
+	def get(self, url, params=None, stream=False):
+		self.calls += 1
+		response = requests.Response()
+		response.status_code = 200
+		response.raw = BytesIO(self.content)
+		return response
+
+
+def test_overpass_request_cached(tmp_path, monkeypatch):
+	monkeypatch.setattr(municipality_split, 'overpass_cache_folder', str(tmp_path))
+	elements = [{"type": "node", "id": 1, "lat": 59.8111, "lon": 10.7183}]
+	session = FakeSession(json.dumps({"elements": elements}).encode())
+
+	for _ in range(2):
+		file = overpass_request(session, "query")
+		assert list(overpass_elements(file)) == elements
+
+	assert session.calls == 1
+
+
+@pytest.mark.parametrize('use_ijson', [True, False])
+def test_overpass_request_error_not_cached(tmp_path, monkeypatch, use_ijson):
+	monkeypatch.setattr(municipality_split, 'overpass_cache_folder', str(tmp_path))
+	if not use_ijson:
+		monkeypatch.setattr(municipality_split, 'ijson', None)
+
+	with pytest.raises(RuntimeError, match="timed out"):
+		overpass_request(FakeSession(b'{"elements": [], "remark": "runtime error: Query timed out"}'), "query")
+	assert os.listdir(tmp_path) == []
+
+	with pytest.raises(Exception):  # Incomplete json
+		overpass_request(FakeSession(b'{"elements": [{"type": "node", "id": 1'), "query")
+	assert os.listdir(tmp_path) == []
+
+
+def test_overpass2features_parallel(monkeypatch):
+	elements = (
+		[{"type": "node", "id": node_id, "lon": lon, "lat": lat} for node_id, (lon, lat) in test_nodes.items()] +
+		[dict(way, type="way") for way in relation_ways] +
+		[relation, dict(relation, id=43, tags={"name": "nordre test"})]
+	)
+	expected = list(overpass2features(elements))
+
+	monkeypatch.setattr(municipality_split, 'parallel_relations', 1)
+	assert list(overpass2features(elements)) == expected
+	assert [feature['properties']['name'] for feature in expected] == ["søndre test", "nordre test"]
@@ -29,6 +29,33 @@ sm_EccSquared = 6.69437999013e-03
  
 UTMScaleFactor = 0.9996
 
+# Series constants depending only on the ellipsoid, precalculated once
+# (see ArcLengthOfMeridian, FootpointLatitude and MapXYToLatLon for the equations)
+_n = (sm_a - sm_b) / (sm_a + sm_b)
+
+_alpha = ((sm_a + sm_b) / 2.0) \
+    * (1.0 + (math.pow (_n, 2.0) / 4.0) + (math.pow (_n, 4.0) / 64.0))
+_beta = (-3.0 * _n / 2.0) + (9.0 * math.pow (_n, 3.0) / 16.0) \
+    + (-3.0 * math.pow (_n, 5.0) / 32.0)
+_gamma = (15.0 * math.pow (_n, 2.0) / 16.0) \
+    + (-15.0 * math.pow (_n, 4.0) / 32.0)
+_delta = (-35.0 * math.pow (_n, 3.0) / 48.0) \
+    + (105.0 * math.pow (_n, 5.0) / 256.0)
+_epsilon = (315.0 * math.pow (_n, 4.0) / 512.0)
+
+_alpha_ = ((sm_a + sm_b) / 2.0) \
+    * (1 + (math.pow (_n, 2.0) / 4) + (math.pow (_n, 4.0) / 64))
+_beta_ = (3.0 * _n / 2.0) + (-27.0 * math.pow (_n, 3.0) / 32.0) \
+    + (269.0 * math.pow (_n, 5.0) / 512.0)
+_gamma_ = (21.0 * math.pow (_n, 2.0) / 16.0) \
+    + (-55.0 * math.pow (_n, 4.0) / 32.0)
+_delta_ = (151.0 * math.pow (_n, 3.0) / 96.0) \
+    + (-417.0 * math.pow (_n, 5.0) / 128.0)
+_epsilon_ = (1097.0 * math.pow (_n, 4.0) / 512.0)
+
+_ep2 = (math.pow (sm_a, 2.0) - math.pow (sm_b, 2.0)) / math.pow (sm_b, 2.0)
+_a2 = math.pow (sm_a, 2.0)
+
 
 def DegToFloat(degrees, minutes, seconds):
     '''
@@ -73,34 +100,12 @@ def ArcLengthOfMeridian(phi):
     The ellipsoidal distance of the point from the equator, in meters.
     '''
  
-    # Precalculate n
-    n = (sm_a - sm_b) / (sm_a + sm_b)
- 
-    # Precalculate alpha
-    alpha = ((sm_a + sm_b) / 2.0) \
-        * (1.0 + (math.pow (n, 2.0) / 4.0) + (math.pow (n, 4.0) / 64.0))
- 
-    # Precalculate beta
-    beta = (-3.0 * n / 2.0) + (9.0 * math.pow (n, 3.0) / 16.0) \
-        + (-3.0 * math.pow (n, 5.0) / 32.0)
- 
-    # Precalculate gamma
-    gamma = (15.0 * math.pow (n, 2.0) / 16.0) \
-        + (-15.0 * math.pow (n, 4.0) / 32.0)
- 
-    # Precalculate delta
-    delta = (-35.0 * math.pow (n, 3.0) / 48.0) \
-        + (105.0 * math.pow (n, 5.0) / 256.0)
- 
-    # Precalculate epsilon
-    epsilon = (315.0 * math.pow (n, 4.0) / 512.0)
- 
-    # Now calculate the sum of the series and return
-    result = alpha \
-        * (phi + (beta * math.sin (2.0 * phi)) \
-           + (gamma * math.sin (4.0 * phi)) \
-           + (delta * math.sin (6.0 * phi)) \
-           + (epsilon * math.sin (8.0 * phi)))
+    # Calculate the sum of the series (constants precalculated at module level)
+    result = _alpha \
+        * (phi + (_beta * math.sin (2.0 * phi)) \
+           + (_gamma * math.sin (4.0 * phi)) \
+           + (_delta * math.sin (6.0 * phi)) \
+           + (_epsilon * math.sin (8.0 * phi)))
  
     return result
 
@@ -135,37 +140,15 @@ def FootpointLatitude(y):
     The footpoint latitude, in radians.
     '''
  
-    # Precalculate n (Eq. 10.18)
-    n = (sm_a - sm_b) / (sm_a + sm_b)
- 
-    # Precalculate alpha_ (Eq. 10.22)
-    # (Same as alpha in Eq. 10.17)
-    alpha_ = ((sm_a + sm_b) / 2.0) \
-        * (1 + (math.pow (n, 2.0) / 4) + (math.pow (n, 4.0) / 64))
- 
     # Precalculate y_ (Eq. 10.23)
-    y_ = y / alpha_
- 
-    # Precalculate beta_ (Eq. 10.22)
-    beta_ = (3.0 * n / 2.0) + (-27.0 * math.pow (n, 3.0) / 32.0) \
-        + (269.0 * math.pow (n, 5.0) / 512.0)
- 
-    # Precalculate gamma_ (Eq. 10.22)
-    gamma_ = (21.0 * math.pow (n, 2.0) / 16.0) \
-        + (-55.0 * math.pow (n, 4.0) / 32.0)
- 
-    # Precalculate delta_ (Eq. 10.22)
-    delta_ = (151.0 * math.pow (n, 3.0) / 96.0) \
-        + (-417.0 * math.pow (n, 5.0) / 128.0)
- 
-    # Precalculate epsilon_ (Eq. 10.22)
-    epsilon_ = (1097.0 * math.pow (n, 4.0) / 512.0)
+    # Constants of Eq. 10.18 and 10.22 are precalculated at module level
+    y_ = y / _alpha_
  
     # Now calculate the sum of the series (Eq. 10.21)
-    result = y_ + (beta_ * math.sin (2.0 * y_)) \
-        + (gamma_ * math.sin (4.0 * y_)) \
-        + (delta_ * math.sin (6.0 * y_)) \
-        + (epsilon_ * math.sin (8.0 * y_))
+    result = y_ + (_beta_ * math.sin (2.0 * y_)) \
+        + (_gamma_ * math.sin (4.0 * y_)) \
+        + (_delta_ * math.sin (6.0 * y_)) \
+        + (_epsilon_ * math.sin (8.0 * y_))
  
     return result
 
@@ -189,14 +172,11 @@ def MapLatLonToXY(phi, lambda_pt, lambda_ctr):
     of the computed point.
     '''
  
-    # Precalculate ep2
-    ep2 = (math.pow (sm_a, 2.0) - math.pow (sm_b, 2.0)) / math.pow (sm_b, 2.0)
- 
     # Precalculate nu2
-    nu2 = ep2 * math.pow (math.cos (phi), 2.0)
+    nu2 = _ep2 * math.pow (math.cos (phi), 2.0)
  
     # Precalculate N
-    N = math.pow (sm_a, 2.0) / (sm_b * math.sqrt (1 + nu2))
+    N = _a2 / (sm_b * math.sqrt (1 + nu2))
  
     # Precalculate t
     t = math.tan (phi)
@@ -271,18 +251,14 @@ def MapXYToLatLon(x, y, lambda_ctr):
     # Get the value of phif, the footpoint latitude.
     phif = FootpointLatitude (y)
  
-    # Precalculate ep2
-    ep2 = (math.pow (sm_a, 2.0) - math.pow (sm_b, 2.0)) \
-        / math.pow (sm_b, 2.0)
- 
     # Precalculate cos (phif)
     cf = math.cos (phif)
  
     # Precalculate nuf2
-    nuf2 = ep2 * math.pow (cf, 2.0)
+    nuf2 = _ep2 * math.pow (cf, 2.0)
  
     # Precalculate Nf and initialize Nfpow
-    Nf = math.pow (sm_a, 2.0) / (sm_b * math.sqrt (1 + nuf2))
+    Nf = _a2 / (sm_b * math.sqrt (1 + nuf2))
     Nfpow = Nf
  
     # Precalculate tf